@@ -4,8 +4,10 @@
 
 import os
 import argparse
-from bs4 import BeautifulSoup
 from utils import *
+from extractor import Extractor
+from site_specs import SITE_SPECS
+from rate_limiter import HostRateLimiter
 
 # 多进程的锁
 m_lock = multiprocessing.Lock
@@ -29,38 +31,16 @@ def get_chapters_links(html):
     return links
 
 
+# 抽取规则见 site_specs.py
+EXTRACTOR = Extractor(SITE_SPECS['17k'])
+
+
 def get_title(html):
-    try:
-        soup = BeautifulSoup(html, 'lxml')
-        title = remove_html_tag(str(soup.find('h1')))
-        return title
-    except Exception as e:
-        logging.warning('Get title: {}'.format(e))
-        return ''
+    return EXTRACTOR.title(html)
 
 
 def get_text(html):
-    try:
-        soup = BeautifulSoup(html, 'lxml')
-        question = soup.findAll('div', {'class': "p"})
-        if len(question) == 0:
-            return ''
-
-        raw_zw = re.findall('<div class="p">[\s\S]+本书首发来自17K小说网，第一时间看正版内容！<br/>',
-                            str(question))
-        if raw_zw:
-            s = '<html><body>' + str(raw_zw[0]) + '</body></html>'
-            soup2 = BeautifulSoup(s, 'lxml')
-            text = ''
-            for i in soup2.find_all('div'):
-                i = remove_html_tag(str(i))
-                text += i.strip()
-            return text[:-23]
-        else:
-            return ''
-    except Exception as e:
-        logging.warning('Get text: {}'.format(e))
-        return ''
+    return EXTRACTOR.body(html)
 
 
 def is_vip_book(html):
@@ -158,6 +138,8 @@ class Spider(object):
 
     def start(self):
         self.load_list_number()
+        if args.rate:
+            set_rate_limiter(HostRateLimiter(args.rate, args.burst))
         processes = []
         for i in range(self.process_num):
             t = multiprocessing.Process(target=self.run, args=())
@@ -172,6 +154,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('output', help='输出文件夹路径，末尾不要带斜杠')
     parser.add_argument('-n', help='多进程数量（默认为1）', type=int, default=1)
+    parser.add_argument('--rate', help='每个网站每秒最多请求数，所有进程共享（默认不限速）', type=float, default=0)
+    parser.add_argument('--burst', help='限速时允许的瞬时突发请求数（默认等于 rate）', type=float, default=0)
     parser.add_argument('--log', help='输出log到文件，否则输出到控制台', action='store_true')
     args = parser.parse_args()
 
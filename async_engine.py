@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-10
+#
+# 依赖 aiohttp 库: pip install aiohttp
+#
+# 基于 asyncio 的抓取引擎
+# 一个进程里同时挂着成百上千个请求，解析放到进程池里执行，不阻塞事件循环
+# 会阻塞的调用（取 ID、进程锁、SQLite 事务、网络请求）用 engine.call 放到线程池里执行
+#
+# 用法（每个爬虫脚本的 Spider 提供 crawl_async(engine) 协程，处理一个帖子/链接）
+# engine = AsyncEngine(concurrency=500)
+# engine.run(spider.crawl_async)
+
+import os
+import asyncio
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from utils import *
+
+
+class AsyncEngine(object):
+
+    def __init__(self, concurrency, parse_workers=None, use_proxy=None, io_workers=4):
+        """
+        :param concurrency: 同时在飞的请求数（同时也是协程数）
+        :param parse_workers: 解析进程数，默认为 CPU 核数
+        :param use_proxy: 是否使用代理，默认设置了代理池就使用
+        :param io_workers: 执行会阻塞的调用的线程数
+        """
+        self.concurrency = concurrency
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.use_proxy = use_proxy
+        self.io_workers = io_workers
+        self.session = None
+        self.parse_pool = None
+        self.io_pool = None
+
+    async def fetch_html(self, url, policy=None):
+        """
+        异步获取URL的源代码，重试规则与 utils.fetch_html 一致
+        :param url: 网址
+        :param policy: 重试策略，默认 RETRY_POLICY
+        :return: FetchResult
+        """
+        import aiohttp
+
+        policy = policy or RETRY_POLICY
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        end_time = start_time + policy.deadline
+        limiter = get_rate_limiter()
+        proxy_pool = get_proxy_pool()
+        limits = get_stream_limits()
+        use_proxy = self.use_proxy
+        if use_proxy is None:
+            use_proxy = proxy_pool is not None
+        host = urlsplit(url).hostname or ''
+        attempts = 0
+        status_code = None
+        error = None
+        while True:
+            if limiter is not None:
+                await asyncio.sleep(limiter.reserve(host))
+            remaining = end_time - loop.time()
+            if remaining <= 0:
+                return FetchResult(url, 'deadline', status_code=status_code, error=error, attempts=attempts,
+                                   elapsed=loop.time() - start_time)
+            attempts += 1
+            proxy = None
+            try:
+                headers = {'user-agent': random.choice(USER_AGENT_LIST)}
+                if use_proxy and proxy_pool is not None:
+                    proxy = proxy_pool.choose()
+                timeout = aiohttp.ClientTimeout(total=min(policy.timeout, remaining))
+                request_time = loop.time()
+                async with self.session.get(url, headers=headers, proxy=proxy, timeout=timeout) as resp:
+                    status_code = resp.status
+                    if proxy:
+                        proxy_pool.report(proxy, status_code not in PROXY_BANNED_STATUS_CODES,
+                                          loop.time() - request_time)
+                    if status_code < 400:
+                        content_type = resp.headers.get('Content-Type', '')
+                        if limits is not None:
+                            reason, content = await self._read_limited(resp, limits)
+                            if reason is not None:
+                                html = decode_html(url, content_type, content) if reason == 'aborted' else ''
+                                return FetchResult(url, reason, html=html, status_code=status_code,
+                                                   attempts=attempts, elapsed=loop.time() - start_time)
+                        else:
+                            content = await resp.read()
+                        html = decode_html(url, content_type, content)
+                        return FetchResult(url, 'ok', html=html, status_code=status_code, attempts=attempts,
+                                           elapsed=loop.time() - start_time)
+                error = 'HTTP {}'.format(status_code)
+                retryable = policy.is_retryable_status(status_code)
+                if proxy and status_code in PROXY_BANNED_STATUS_CODES:
+                    retryable = True
+            except (aiohttp.InvalidURL, aiohttp.TooManyRedirects) as e:
+                error = e
+                retryable = False
+            except Exception as e:
+                error = e
+                retryable = True
+                if proxy:
+                    proxy_pool.report(proxy, False)
+
+            if not retryable:
+                return FetchResult(url, 'permanent', status_code=status_code, error=error, attempts=attempts,
+                                   elapsed=loop.time() - start_time)
+            if attempts >= policy.max_attempts:
+                return FetchResult(url, 'exhausted', status_code=status_code, error=error, attempts=attempts,
+                                   elapsed=loop.time() - start_time)
+            await asyncio.sleep(min(policy.backoff(attempts - 1), max(0, end_time - loop.time())))
+
+    @staticmethod
+    async def _read_limited(resp, limits):
+        # 和 utils.read_limited 相同，提前结束时关闭连接
+        body = bytearray()
+        content_length = resp.headers.get('Content-Length')
+        reason = limits.check_headers(resp.headers.get('Content-Type', ''), content_length)
+        if reason is None:
+            async for chunk in resp.content.iter_chunked(limits.chunk_size):
+                reason = limits.feed(body, chunk)
+                if reason is not None:
+                    break
+            if reason == 'aborted' and limits.should_drain(len(body), content_length):
+                await resp.read()
+                return reason, bytes(body)
+        if reason is not None:
+            resp.close()
+        return reason, bytes(body)
+
+    async def get_html(self, url):
+        """
+        异步获取URL的源代码
+        :param url: 网址
+        :return: 网页源代码，失败返回空字符串
+        """
+        result = await self.fetch_html(url)
+        if not result.ok:
+            if result.status not in QUIET_FETCH_STATUSES:
+                logging.error('Get html ({0}): {1}: {2}'.format(result.status, result.error, url))
+            return ''
+        return result.html
+
+    async def parse(self, func, *args):
+        """
+        在解析进程池中执行 func(*args)，func 必须是模块级函数
+        :return: func 的返回值
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.parse_pool, func, *args)
+
+    async def call(self, func, *args):
+        """
+        在线程池中执行会阻塞的 func(*args)，等待期间其他协程照常运行
+        :return: func 的返回值
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_pool, func, *args)
+
+    async def _worker(self, crawl):
+        # crawl 返回 False 表示没有任务了
+        while True:
+            try:
+                if await crawl(self) is False:
+                    break
+            except Exception as e:
+                logging.critical('尚未预料到的错误: {}'.format(e))
+
+    async def _run(self, crawl):
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=RETRY_POLICY.timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
+            workers = [asyncio.ensure_future(self._worker(crawl)) for _ in range(self.concurrency)]
+            await asyncio.gather(*workers)
+
+    def run(self, crawl):
+        """
+        启动事件循环，直到所有协程的 crawl 都返回 False
+        :param crawl: 协程函数 crawl(engine)，每次处理一个任务
+        """
+        self.parse_pool = ProcessPoolExecutor(self.parse_workers)
+        self.io_pool = ThreadPoolExecutor(self.io_workers)
+        try:
+            asyncio.run(self._run(crawl))
+        finally:
+            self.parse_pool.shutdown()
+            self.io_pool.shutdown()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-02-02
+#
+# 在本地起一个模拟 ID 空间的 HTTP 服务，测试 id_discovery.py 找前沿和估计密度的准确度
+# ID 越新有效帖子越密（旧帖子大多已被删除），超过前沿的 ID 都不存在
+#
+# 用法
+# python3 bench_discover.py --frontier 9000000000 --low 5000000000
+
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import *
+from id_discovery import IdSpaceProber, log_profile
+
+PAGE_BODY = '<html><head><meta charset="utf-8"><title>帖子{}</title></head><body><p>测试内容</p></body></html>'
+
+
+class SyntheticIdSpace(object):
+
+    def __init__(self, frontier, low=0, old_density=0.02, new_density=0.6):
+        """
+        :param frontier: 有效帖子 ID 的上界，它本身是否有效和附近的 ID 一样按密度决定
+        :param low: 在它之前按 old_density 计算
+        :param old_density: 最旧的帖子中有效的比例
+        :param new_density: 最新的帖子中有效的比例
+        """
+        self.frontier = frontier
+        self.low = low
+        self.old_density = old_density
+        self.new_density = new_density
+
+    def density(self, post_id):
+        if post_id > self.frontier:
+            return 0.0
+        position = max(0.0, (post_id - self.low) / max(self.frontier - self.low, 1))
+        return self.old_density + (self.new_density - self.old_density) * position ** 4
+
+    def is_live(self, post_id):
+        digest = hashlib.blake2b(str(post_id).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') / 2 ** 64 < self.density(post_id)
+
+    def last_live_id(self):
+        # 真实的前沿：上界往下第一个有效的 ID
+        post_id = self.frontier
+        while post_id > self.low and not self.is_live(post_id):
+            post_id -= 1
+        return post_id
+
+    def percentile_id(self, percentile, steps=10000):
+        # 按密度函数积分得到真实的百分位
+        span = self.frontier - self.low
+        weights = [self.density(self.low + span * i // steps) for i in range(steps)]
+        target = sum(weights) * percentile / 100
+        cumulative = 0
+        for i, weight in enumerate(weights):
+            cumulative += weight
+            if cumulative >= target:
+                return self.low + span * i // steps
+        return self.frontier
+
+
+class SyntheticHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        post_id = self.path.rsplit('/', 1)[-1]
+        if post_id.isdigit() and self.server.id_space.is_live(int(post_id)):
+            body = PAGE_BODY.format(post_id).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+        else:
+            body = b''
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SyntheticServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def start_synthetic_server(id_space):
+    server = SyntheticServer(('127.0.0.1', 0), SyntheticHandler)
+    server.id_space = id_space
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frontier', help='模拟的有效ID上界（默认为9000000000）', type=int, default=9000000000)
+    parser.add_argument('--low', help='从哪个ID开始探测（默认为5000000000）', type=int, default=5000000000)
+    parser.add_argument('--window', help='每个探测点的ID范围（默认为1000）', type=int, default=1000)
+    parser.add_argument('--samples', help='每个探测点每轮抽多少个ID（默认为20）', type=int, default=20)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s|%(levelname)s: %(message)s', level=logging.WARNING)
+    id_space = SyntheticIdSpace(args.frontier, args.low)
+    server = start_synthetic_server(id_space)
+    url = 'http://127.0.0.1:{}/p/'.format(server.server_address[1])
+    configure_session(pool_maxsize=8)
+
+    prober = IdSpaceProber(lambda post_id: bool(get_html(url + str(post_id))), args.window, args.samples)
+    start_time = time.time()
+    frontier = prober.find_frontier(args.low)
+    frontier_requests = prober.requests
+    profile = prober.profile(args.low, frontier)
+    log_profile(profile)
+
+    real_frontier = id_space.last_live_id()
+    print('前沿: 真实 {0}，探测到 {1}，相差 {2}，用了 {3} 次请求'.format(
+        real_frontier, frontier, real_frontier - frontier, frontier_requests))
+    for percentile in (50, 90, 99):
+        print('{0}% 百分位: 真实 {1}，估计 {2}'.format(
+            percentile, id_space.percentile_id(percentile), IdSpaceProber.percentile_id(profile, percentile)))
+    print('共 {0} 次请求，{1:.1f} 秒'.format(prober.requests, time.time() - start_time))
+    server.shutdown()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-22
+#
+# 抽取函数的性能测试，不访问网络，使用 fixtures/ 下保存的网页
+# 输出每个函数的 ops/sec、单次耗时的 p50/p90/p99、单次调用的 Python 内存分配峰值
+# 结果保存在脚本所在目录的 bench_results/<label>.json，用 --compare 和之前的结果对比
+# bench_results/baseline.json 提交在仓库里，作为版本之间对比的基准，不指定 --compare 时和它对比；
+# 有意改变了性能（或者换了测试机器）时用 --label baseline 重新生成并提交。其余结果文件不提交
+#
+# 用法
+# python3 bench_extract.py --label v1.2
+# python3 bench_extract.py --label v1.3 --compare bench_results/v1.2.json
+# python3 bench_extract.py --label baseline   # 更新基准
+# python3 bench_extract.py --record tieba_post.html https://tieba.baidu.com/p/5000000001   # 重新录制样本
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import importlib.util
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results')
+BASELINE_FILE = os.path.join(RESULTS_DIR, 'baseline.json')
+
+# (脚本, 函数, 样本)
+BENCH_CASES = [
+    ('tieba_spider.py', 'get_title', 'tieba_post.html'),
+    ('tieba_spider.py', 'get_whole_page_content', 'tieba_post.html'),
+    ('tieba_spider.py', 'get_posts_num', 'tieba_post.html'),
+    ('tieba_spider.py', 'parse_post_page', 'tieba_post.html'),
+    ('hupu_spider.py', 'get_title', 'hupu_thread.html'),
+    ('hupu_spider.py', 'get_content', 'hupu_thread.html'),
+    ('hupu_spider.py', 'get_posts_num', 'hupu_thread.html'),
+    ('tianya_spider.py', 'get_title', 'tianya_thread.html'),
+    ('tianya_spider.py', 'get_content', 'tianya_thread.html'),
+    ('tianya_spider.py', 'get_posts_num', 'tianya_thread.html'),
+    ('baidu_baike.py', 'get_content', 'baike_item.html'),
+    ('baidu_baike.py', 'get_all_links', 'baike_item.html'),
+    ('news_spider.py', 'get_content', '163_article.html'),
+    ('news_spider.py', 'get_all_links', '163_article.html'),
+    ('17k_spider.py', 'get_title', '17k_chapter.html'),
+    ('17k_spider.py', 'get_text', '17k_chapter.html'),
+]
+
+
+def load_script(file_name):
+    # 17k_spider 这种以数字开头的文件不能直接 import
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    spec = importlib.util.spec_from_file_location('bench_' + file_name[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_fixture(file_name):
+    with open(os.path.join(FIXTURES_DIR, file_name), 'r', encoding='utf-8') as fr:
+        return fr.read()
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def bench_function(func, html, min_seconds):
+    """
+    :param func: 抽取函数
+    :param html: 网页源码
+    :param min_seconds: 最少运行秒数
+    :return: 结果字典
+    """
+    for _ in range(3):
+        func(html)
+
+    latencies = []
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < min_seconds or len(latencies) < 20:
+        call_start = time.perf_counter()
+        func(html)
+        latencies.append(time.perf_counter() - call_start)
+    total = time.perf_counter() - start_time
+    latencies.sort()
+
+    # 内存单独测，tracemalloc 会拖慢计时；lxml 在 C 里分配的内存不计入
+    tracemalloc.start()
+    func(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'calls': len(latencies),
+        'ops_per_sec': len(latencies) / total,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p90_us': percentile(latencies, 90) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        'py_peak_alloc_kb': peak / 1024,
+    }
+
+
+def run_benchmarks(min_seconds, only=None):
+    modules = {}
+    results = {}
+    for script, func_name, fixture in BENCH_CASES:
+        name = '{0}.{1}'.format(script[:-3], func_name)
+        if only and only not in name:
+            continue
+        if script not in modules:
+            modules[script] = load_script(script)
+        func = getattr(modules[script], func_name)
+        results[name] = bench_function(func, load_fixture(fixture), min_seconds)
+        results[name]['fixture'] = fixture
+        print_result(name, results[name])
+    return results
+
+
+def print_result(name, result, previous=None):
+    line = '{0:<40} {1:>10.1f} ops/s  p50 {2:>9.1f}us  p90 {3:>9.1f}us  p99 {4:>9.1f}us  py peak {5:>8.1f}KB'.format(
+        name, result['ops_per_sec'], result['p50_us'], result['p90_us'], result['p99_us'], result['py_peak_alloc_kb'])
+    if previous:
+        change = (result['ops_per_sec'] / previous['ops_per_sec'] - 1) * 100
+        line += '  {0:+.1f}% ops/s'.format(change)
+        if change < -10:
+            line += '  <-- 变慢'
+    print(line)
+
+
+def save_results(label, results):
+    if not os.path.exists(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+    path = os.path.join(RESULTS_DIR, label + '.json')
+    with open(path, 'w', encoding='utf-8') as fw:
+        json.dump({
+            'label': label,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }, fw, ensure_ascii=False, indent=2)
+    return path
+
+
+def compare_results(results, previous_path):
+    with open(previous_path, 'r', encoding='utf-8') as fr:
+        previous = json.load(fr)
+    print('\n对比 {0} ({1}):'.format(previous['label'], previous['time']))
+    for name, result in results.items():
+        print_result(name, result, previous['results'].get(name))
+
+
+def record_fixture(file_name, url):
+    # 把线上网页保存为样本
+    from utils import get_html
+
+    html = get_html(url)
+    if not html:
+        print('获取失败: {}'.format(url))
+        return
+    with open(os.path.join(FIXTURES_DIR, file_name), 'w', encoding='utf-8') as fw:
+        fw.write(html)
+    print('已保存 {0} ({1} 字节)'.format(file_name, len(html)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--label', help='结果名称（默认为当前时间）', type=str, default='')
+    parser.add_argument('--compare', help='与之前保存的结果文件对比（默认为 bench_results/baseline.json）',
+                        type=str, default='')
+    parser.add_argument('--seconds', help='每个函数至少运行的秒数（默认为1）', type=float, default=1.0)
+    parser.add_argument('--only', help='只测名称包含该字符串的函数', type=str, default='')
+    parser.add_argument('--record', help='录制样本: --record 样本文件名 URL', nargs=2, metavar=('FIXTURE', 'URL'))
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixture(*args.record)
+        sys.exit(0)
+
+    bench_results = run_benchmarks(args.seconds, args.only)
+    saved_path = save_results(args.label or time.strftime('%Y%m%d_%H%M%S'), bench_results)
+    print('\n结果已保存到 {}'.format(saved_path))
+    compare_path = args.compare
+    if not compare_path and os.path.exists(BASELINE_FILE) and os.path.abspath(saved_path) != BASELINE_FILE:
+        compare_path = BASELINE_FILE
+    if compare_path:
+        compare_results(bench_results, compare_path)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-08
+#
+# 在本地起一个 HTTP 服务代替真实网站，对比抓取层的性能
+# 统计每 1000 个页面建立了多少次 TCP 连接（握手次数）以及每秒页面数
+# 以及被删帖子的页面完整下载和流式下载（出现提示语就断开）的对比
+#
+# 用法
+# python3 bench_fetch.py -n 1000
+
+import sys
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import *
+from site_specs import SITE_SPECS
+
+# 模拟网页大小
+PAGE_BODY = ('<html><head><meta charset="utf-8"><title>测试</title></head><body>' +
+             '<p>测试内容</p>' * 500 + '</body></html>').encode('utf-8')
+# 被删帖子的页面: 提示语在前面，后面还有大段脚本和样式
+DELETED_BODY = ('<html><head><meta charset="utf-8"><title>贴吧404</title></head><body><h3>很抱歉，该贴已被删除。</h3>' +
+                '<script>var x = "测试内容";</script>' * 5000 + '</body></html>').encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 才会保持连接
+    protocol_version = 'HTTP/1.1'
+    # 否则 keep-alive 连接上会被 Nagle 算法和延迟 ACK 拖慢
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        # /missing/ 开头的路径模拟 404 页面
+        if self.path.startswith('/missing/'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        # /deleted/ 开头的路径模拟被删的帖子
+        body = DELETED_BODY if self.path.startswith('/deleted/') else PAGE_BODY
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # 流式下载提前断开了连接
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handshakes = 0
+        self.count_lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # 流式下载提前断开的连接
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def get_request(self):
+        # 每 accept 一次就是一次新的 TCP 握手
+        request = super().get_request()
+        with self.count_lock:
+            self.handshakes += 1
+        return request
+
+
+def start_stand_in_server():
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def one_shot_get_html(url):
+    # 改动前的抓取方式：每个 URL 都新建一次连接
+    headers = {'user-agent': random.choice(USER_AGENT_LIST)}
+    return requests.get(url, timeout=20, headers=headers).text
+
+
+def bench(name, fetch, base_url, pages, server):
+    server.handshakes = 0
+    start_time = time.time()
+    for i in range(pages):
+        fetch('{0}p/{1}'.format(base_url, i))
+    cost = time.time() - start_time
+    print('{0:<12} pages: {1:<6} handshakes/1000 pages: {2:<8.1f} pages/sec: {3:.1f}'.format(
+        name, pages, server.handshakes * 1000 / pages, pages / cost))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', help='请求页面数（默认为1000）', type=int, default=1000)
+    args = parser.parse_args()
+
+    stand_in = start_stand_in_server()
+    url = 'http://127.0.0.1:{}/'.format(stand_in.server_address[1])
+
+    bench('requests.get', one_shot_get_html, url, args.n, stand_in)
+    bench('get_html', get_html, url, args.n, stand_in)
+    bench('get_html 404', get_html, url + 'missing/', args.n, stand_in)
+    bench('deleted', get_html, url + 'deleted/', args.n, stand_in)
+    set_stream_limits(StreamLimits.from_site_spec(SITE_SPECS['tieba']))
+    bench('stream del', get_html, url + 'deleted/', args.n, stand_in)
+    bench('stream', get_html, url, args.n, stand_in)
+    stand_in.shutdown()
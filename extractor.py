@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-18
+#
+# 按声明式的站点规则（site_specs.py）抽取标题、正文、页数、链接
+# 选择器用简单的 CSS 写法（tag、.class、#id、[attr]、空格、>、逗号），
+# 创建 Extractor 时一次性编译成 lxml 的 XPath；没有 lxml 时退回 BeautifulSoup
+#
+# 用法
+# extractor = Extractor(SITE_SPECS['tieba'])
+# doc = extractor.document(html)       # 只解析一次
+# extractor.title(doc), extractor.body(doc), extractor.page_count(doc)
+
+import re
+import logging
+
+try:
+    from lxml import etree
+    import lxml.html
+    DEFAULT_BACKEND = 'lxml'
+except ImportError:
+    DEFAULT_BACKEND = 'bs4'
+
+SIMPLE_SELECTOR_RE = re.compile(r'[.#][-\w]+|\[[-\w]+\]')
+
+
+def css_to_xpath(selector):
+    """
+    把简单的 CSS 选择器翻译成 XPath
+    :param selector: 如 'div.d_post_content_main div.d_post_content, h1'
+    :return: XPath 表达式
+    """
+    paths = []
+    for group in selector.split(','):
+        xpath = ''
+        axis = '//'
+        for token in group.replace('>', ' > ').split():
+            if token == '>':
+                axis = '/'
+                continue
+            match = re.match(r'([\w*]*)(.*)', token)
+            tag = match.group(1) or '*'
+            predicates = ''
+            for part in SIMPLE_SELECTOR_RE.findall(match.group(2)):
+                if part[0] == '.':
+                    predicates += "[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]".format(part[1:])
+                elif part[0] == '#':
+                    predicates += "[@id='{}']".format(part[1:])
+                else:
+                    predicates += '[@{}]'.format(part[1:-1])
+            xpath += axis + tag + predicates
+            axis = '//'
+        paths.append('.' + xpath)
+    return ' | '.join(paths)
+
+
+class Document(object):
+    """
+    解析好的页面，同一页面的所有抽取都在这棵树上进行
+    """
+
+    def __init__(self, html, root):
+        self.html = html
+        self.root = root
+
+
+class LxmlBackend(object):
+    name = 'lxml'
+
+    def __init__(self):
+        self.string = etree.XPath('string()')
+        self.utf8_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+    def parse(self, html):
+        try:
+            return lxml.html.document_fromstring(html)
+        except ValueError:
+            # 带 <?xml encoding=...?> 声明的页面不能直接解析 str
+            return lxml.html.document_fromstring(html.encode('utf-8'), parser=self.utf8_parser)
+        except etree.ParserError:
+            return lxml.html.document_fromstring('<html></html>')
+
+    def compile(self, selector):
+        return etree.XPath(css_to_xpath(selector))
+
+    def select(self, node, compiled):
+        return compiled(node)
+
+    def attr(self, node, name):
+        return node.get(name)
+
+    def remove(self, node, compiled):
+        for element in compiled(node):
+            # drop_tree 会保留节点后面的文本
+            element.drop_tree()
+
+    def text(self, node, br=None):
+        if br is None:
+            return self.string(node)
+        parts = []
+        self._walk(node, br, parts)
+        return ''.join(parts)
+
+    def _walk(self, element, br, parts):
+        # 注释等节点的 tag 不是字符串，跳过其内容只保留尾部文本
+        if not isinstance(element.tag, str):
+            return
+        if element.tag == 'br':
+            parts.append(br)
+        if element.text:
+            parts.append(element.text)
+        for child in element:
+            self._walk(child, br, parts)
+            if child.tail:
+                parts.append(child.tail)
+
+
+class Bs4Backend(object):
+    name = 'bs4'
+
+    def __init__(self):
+        from bs4 import BeautifulSoup
+        self.soup_class = BeautifulSoup
+
+    def parse(self, html):
+        return self.soup_class(html or '', 'html.parser' if DEFAULT_BACKEND == 'bs4' else 'lxml')
+
+    def compile(self, selector):
+        return selector
+
+    def select(self, node, compiled):
+        return node.select(compiled)
+
+    def attr(self, node, name):
+        return node.get(name)
+
+    def remove(self, node, compiled):
+        for element in node.select(compiled):
+            element.extract()
+
+    def text(self, node, br=None):
+        if br is not None:
+            for element in node.find_all('br'):
+                element.replace_with(br)
+        return node.get_text()
+
+
+BACKENDS = {'lxml': LxmlBackend, 'bs4': Bs4Backend}
+
+
+class Extractor(object):
+    """
+    按站点规则抽取内容，规则格式见 site_specs.py
+    """
+
+    def __init__(self, spec, backend=None):
+        self.spec = spec
+        self.backend = BACKENDS[backend or DEFAULT_BACKEND]()
+        compile_selector = self.backend.compile
+
+        title = spec.get('title', {})
+        self.title_selectors = [compile_selector(s) for s in title.get('select', [])]
+        self.title_markers = title.get('markers', [])
+
+        body = spec.get('body', {})
+        self.body_selector = compile_selector(body['select']) if body.get('select') else None
+        self.body_remove = [compile_selector(s) for s in body.get('remove', [])]
+        self.body_br = body.get('br')
+        self.body_subs = [(re.compile(p), r) for p, r in body.get('sub', [])]
+        self.body_match = re.compile(body['match']) if body.get('match') else None
+        self.body_require = body.get('require')
+        self.body_prefix = body.get('prefix', '')
+        self.body_suffix = body.get('suffix', '')
+        self.body_join = body.get('join', '')
+
+        pagination = spec.get('pagination', {})
+        self.page_selector = compile_selector(pagination['select']) if pagination.get('select') else None
+        self.page_attr = pagination.get('attr', 'href')
+        self.page_pattern = re.compile(pagination['pattern']) if pagination.get('pattern') else None
+        self.page_pick = pagination.get('pick', -1)
+
+        links = spec.get('links', {})
+        self.links_pattern = re.compile(links['pattern']) if links.get('pattern') else None
+
+    def document(self, html):
+        """
+        解析网页，已经是 Document 的直接返回
+        :param html: 网页源码或 Document
+        :return: Document
+        """
+        if isinstance(html, Document):
+            return html
+        return Document(html, self.backend.parse(html))
+
+    def title(self, html):
+        """
+        :param html: 网页源码或 Document
+        :return: 标题；没有标题但页面含有提示语（如帖子被删）时返回提示语
+        """
+        try:
+            doc = self.document(html)
+            for selector in self.title_selectors:
+                for node in self.backend.select(doc.root, selector):
+                    title = self.backend.text(node).strip()
+                    if title:
+                        return title
+            for marker in self.title_markers:
+                if marker in doc.html:
+                    return marker
+            return ''
+        except Exception as e:
+            logging.error('Get title: {}'.format(e))
+            return ''
+
+    def body_items(self, html):
+        """
+        :param html: 网页源码或 Document
+        :return: 每一块正文（楼层、段落）的文本列表，空的会被跳过
+        """
+        if self.body_selector is None:
+            return []
+        doc = self.document(html)
+        items = []
+        for node in self.backend.select(doc.root, self.body_selector):
+            for selector in self.body_remove:
+                self.backend.remove(node, selector)
+            text = self.backend.text(node, self.body_br)
+            for pattern, repl in self.body_subs:
+                text = pattern.sub(repl, text)
+            if self.body_match is not None:
+                match = self.body_match.search(text)
+                text = match.group(0) if match else ''
+            text = text.strip()
+            if text:
+                items.append(text)
+        return items
+
+    def body(self, html):
+        """
+        :param html: 网页源码或 Document
+        :return: 拼接好的正文
+        """
+        try:
+            doc = self.document(html)
+            if self.body_require is not None and self.body_require not in doc.html:
+                # 例如 17k 的章节必须带有固定的结尾语，否则说明页面不完整
+                return ''
+            items = self.body_items(doc)
+            return self.body_join.join(self.body_prefix + i + self.body_suffix for i in items)
+        except Exception as e:
+            logging.error('Get content: {}'.format(e))
+            return ''
+
+    def page_count(self, html):
+        """
+        :param html: 网页源码或 Document
+        :return: 页数，找不到分页时为 1
+        """
+        try:
+            if self.page_selector is None:
+                return 1
+            doc = self.document(html)
+            numbers = []
+            for node in self.backend.select(doc.root, self.page_selector):
+                value = self.backend.attr(node, self.page_attr)
+                match = self.page_pattern.search(value) if value else None
+                if match:
+                    numbers.append(int(match.group(1)))
+            return numbers[self.page_pick]
+        except IndexError:
+            return 1
+        except Exception as e:
+            logging.error('Get posts num: {}'.format(e))
+            return 1
+
+    def links(self, html):
+        """
+        :param html: 网页源码或 Document
+        :return: 页面中所有匹配的链接
+        """
+        if self.links_pattern is None:
+            return []
+        if isinstance(html, Document):
+            html = html.html
+        return self.links_pattern.findall(html)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-27
+#
+# 保存在 SQLite 文件里的待爬链接队列，代替 Manager().list() 和 temp_links_base.txt
+# 队列不再受内存限制，出队按主键取最小的一条，O(log n)，不用像 list.pop(0) 那样整体前移
+#
+# 每个进程各自连接数据库（fork 之后第一次使用时建立），WAL 模式下多个进程可以同时读写
+# 同一个进程里的多个线程（异步模式下 engine.call 的线程池）共用连接，由线程锁保证一次只有一个事务
+# 入队先缓存在进程内，攒够一批或者超过一定时间再在一个事务里写入
+# 删除的行多了之后回收空间，避免文件只增不减
+#
+# 出队时不删除，只标记为处理中（claimed 为出队时间），处理完调用 done() 后在下一次写入时删除
+# 每个进程一个事务领 claim_batch 条放在进程内逐条发，同时删除上一批里已经 done 的，不用每条都抢一次写锁
+# 进程崩溃留下的标记超过 claim_timeout 秒后收回，链接重新出队；启动时清除上次运行留下的标记
+# 进程退出前调用 close()：写入缓存的入队和更新，删除处理完的行，还没处理完的链接放回队列
+#
+# 优先级模式: 按 优先级 从高到低出队，优先级 = 种子权重 + 入链数 * inlink_weight - 深度 * depth_weight
+# 已经在队列里的链接又被别的网页引用时，入链数和优先级随之增加（同样先缓存再批量更新）
+
+import os
+import time
+import sqlite3
+import threading
+import collections
+import logging
+
+
+class SqliteFrontier(object):
+
+    def __init__(self, path, batch_size=500, flush_interval=1.0, compact_every=100000,
+                 priority=False, inlink_weight=1.0, depth_weight=1.0, claim_timeout=600, claim_batch=10):
+        """
+        :param path: 数据库文件
+        :param batch_size: 入队缓存多少条后写入
+        :param flush_interval: 入队缓存最多保留多少秒
+        :param compact_every: 每个进程出队多少条后回收一次空间
+        :param priority: 按优先级出队，否则先进先出
+        :param inlink_weight: 每多一个入链增加的优先级
+        :param depth_weight: 每深一层减少的优先级
+        :param claim_timeout: 出队后超过多少秒没有 done 的链接重新出队
+        :param claim_batch: 每个进程一次领多少条（优先级模式下越小越接近严格按优先级出队）
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.priority = priority
+        self.inlink_weight = inlink_weight
+        self.depth_weight = depth_weight
+        self.claim_timeout = claim_timeout
+        self.claim_batch = max(1, claim_batch)
+        self._conn = None
+        self._conn_pid = None
+        # [(链接, 深度, 入链数, 优先级), ...]
+        self._buffer = []
+        # {链接: [增加的入链数, 增加的优先级]}
+        self._updates = {}
+        # {链接: [行 id, ...]} 本进程领到、还没 done 的（同一个链接可能入队了不止一次）
+        self._claimed = {}
+        # 已经领到、还没发出去的 (链接, 深度)
+        self._batch = collections.deque()
+        # 已经 done、等待删除的行 id
+        self._done_ids = []
+        self._last_flush = time.time()
+        self._last_reclaim = time.time()
+        self._pops = 0
+        # 事务和缓存都不能被本进程的其他线程打断，可重入: pop_item 里会调用 flush
+        self._thread_lock = threading.RLock()
+        # 在主进程建表，子进程直接使用
+        conn = self._connect()
+        # 还没有子进程在爬，之前的标记都是上次运行留下的
+        conn.execute('UPDATE frontier SET claimed = 0 WHERE claimed != 0')
+
+    def _connect(self):
+        # 每个进程单独一个连接，不能使用从父进程继承来的连接
+        if self._conn is not None and self._conn_pid == os.getpid():
+            return self._conn
+        # 主进程里恢复去重集合的后台线程也会用这个连接
+        self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn_pid = os.getpid()
+        self._buffer = []
+        self._updates = {}
+        self._claimed = {}
+        self._batch = collections.deque()
+        self._done_ids = []
+        self._pops = 0
+        conn = self._conn
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS frontier (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL)')
+        # 旧版本的队列文件没有这几列
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(frontier)')]
+        for column, definition in (('depth', 'INTEGER NOT NULL DEFAULT 0'), ('inlinks', 'INTEGER NOT NULL DEFAULT 0'),
+                                   ('priority', 'REAL NOT NULL DEFAULT 0'), ('claimed', 'REAL NOT NULL DEFAULT 0')):
+            if column not in columns:
+                conn.execute('ALTER TABLE frontier ADD COLUMN {0} {1}'.format(column, definition))
+        # 处理中的行很少，部分索引很小
+        conn.execute('CREATE INDEX IF NOT EXISTS frontier_claimed ON frontier (claimed) WHERE claimed != 0')
+        if self.priority:
+            conn.execute('CREATE INDEX IF NOT EXISTS frontier_priority ON frontier (priority DESC, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS frontier_url ON frontier (url)')
+        return conn
+
+    def score(self, depth, inlinks, weight=0):
+        # 优先级
+        return weight + inlinks * self.inlink_weight - depth * self.depth_weight
+
+    def push(self, url, depth=0, weight=0):
+        self.push_many([url], depth, weight)
+
+    def push_many(self, urls, depth=0, weight=0):
+        """
+        入队，先放进本进程的缓存
+        :param urls: 链接列表
+        :param depth: 链接的深度（种子为0）
+        :param weight: 种子权重
+        """
+        with self._thread_lock:
+            self._connect()
+            # 从网页上发现的链接算一个入链
+            inlinks = 1 if depth > 0 else 0
+            priority = self.score(depth, inlinks, weight)
+            self._buffer.extend((url, depth, inlinks, priority) for url in urls)
+            self._flush_if_needed()
+
+    def add_inlinks(self, urls, weight=0):
+        """
+        已经入队（或爬过）的链接又被引用，入链数加一；只在优先级模式下有效
+        :param urls: 链接列表，同一网页里的重复链接应事先去掉
+        :param weight: 额外增加的优先级（如种子权重），此时不增加入链数
+        """
+        with self._thread_lock:
+            if not self.priority:
+                return
+            self._connect()
+            for url in urls:
+                update = self._updates.setdefault(url, [0, 0])
+                if weight:
+                    update[1] += weight
+                else:
+                    update[0] += 1
+                    update[1] += self.inlink_weight
+            self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if len(self._buffer) + len(self._updates) >= self.batch_size or \
+                time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        # 把本进程缓存的入队、更新和删除在一个事务里写入
+        with self._thread_lock:
+            conn = self._connect()
+            self._last_flush = time.time()
+            if not self._buffer and not self._updates and not self._done_ids:
+                return
+            buffer, self._buffer = self._buffer, []
+            updates, self._updates = self._updates, {}
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._delete_done(conn)
+                conn.executemany('INSERT INTO frontier (url, depth, inlinks, priority) VALUES (?, ?, ?, ?)', buffer)
+                # 已经爬过的链接不在表里，更新不到任何行
+                conn.executemany('UPDATE frontier SET inlinks = inlinks + ?, priority = priority + ? WHERE url = ?',
+                                 ((inlinks, priority, url) for url, (inlinks, priority) in updates.items()))
+
+    def pop(self):
+        """
+        出队，处理完之后调用 done(链接)
+        :return: 链接，队列为空返回 None
+        """
+        item = self.pop_item()
+        return item[0] if item else None
+
+    def pop_item(self):
+        """
+        出队：先进先出模式取最早入队的，优先级模式取优先级最高的，处理完之后调用 done(链接)
+        :return: (链接, 深度)，队列为空返回 None
+        """
+        with self._thread_lock:
+            conn = self._connect()
+            if (self._buffer or self._updates) and time.time() - self._last_flush >= self.flush_interval:
+                self.flush()
+            if not self._batch:
+                self._claim(conn)
+            if not self._batch:
+                # 队列空了，先把自己缓存的写进去再取，再看有没有崩溃的进程留下的链接
+                if self._buffer:
+                    self.flush()
+                    return self.pop_item()
+                if self.reclaim():
+                    return self.pop_item()
+                return None
+            self._pops += 1
+            if self._pops % self.compact_every == 0:
+                self.compact()
+            return self._batch.popleft()
+
+    def _claim(self, conn):
+        # 一个事务里删除已经 done 的行、领一批链接；在 BEGIN IMMEDIATE 里先查后改，不会和其他进程领到同一行
+        order = 'priority DESC, id' if self.priority else 'id'
+        now = time.time()
+        if now - self._last_reclaim >= 60:
+            self.reclaim()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._delete_done(conn)
+            rows = conn.execute('SELECT id, url, depth FROM frontier WHERE claimed = 0 ORDER BY {} LIMIT ?'.format(
+                order), (self.claim_batch,)).fetchall()
+            if rows:
+                conn.execute('UPDATE frontier SET claimed = ? WHERE id IN ({})'.format(','.join('?' * len(rows))),
+                             [now] + [row[0] for row in rows])
+        for row_id, url, depth in rows:
+            self._claimed.setdefault(url, []).append(row_id)
+            self._batch.append((url, depth))
+
+    def done(self, url):
+        """
+        出队的链接处理完了（无论成功与否），下一次写入时从队列里删除
+        :param url: pop / pop_item 返回的链接
+        """
+        with self._thread_lock:
+            self._done_ids.extend(self._claimed.pop(url, ()))
+
+    def _delete_done(self, conn):
+        # 在调用者的事务里删除已经 done 的行
+        if self._done_ids:
+            done_ids, self._done_ids = self._done_ids, []
+            conn.executemany('DELETE FROM frontier WHERE id = ?', ((row_id,) for row_id in done_ids))
+
+    def reclaim(self):
+        """
+        收回超过 claim_timeout 秒还没 done 的链接（处理它的进程多半已经崩溃）
+        :return: 收回的条数
+        """
+        with self._thread_lock:
+            conn = self._connect()
+            self._last_reclaim = time.time()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                count = conn.execute('UPDATE frontier SET claimed = 0 WHERE claimed != 0 AND claimed < ?',
+                                     (self._last_reclaim - self.claim_timeout,)).rowcount
+            if count:
+                logging.warning('收回 {} 条超时未处理完的链接'.format(count))
+            return count
+
+    def close(self):
+        # 进程退出前调用：写入缓存，删除处理完的行，还没处理完和领到还没发出去的链接放回队列
+        with self._thread_lock:
+            if self._conn is None or self._conn_pid != os.getpid():
+                return
+            self.flush()
+            self._batch.clear()
+            if self._claimed:
+                claimed, self._claimed = self._claimed, {}
+                with self._conn:
+                    self._conn.execute('BEGIN IMMEDIATE')
+                    self._conn.executemany('UPDATE frontier SET claimed = 0 WHERE id = ?',
+                                           ((row_id,) for row_ids in claimed.values() for row_id in row_ids))
+
+    def compact(self):
+        # 回收已删除行占用的空间，并截断 WAL 文件
+        with self._thread_lock:
+            conn = self._connect()
+            try:
+                conn.execute('PRAGMA incremental_vacuum')
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except sqlite3.OperationalError as e:
+                logging.error('Compact frontier: {}'.format(e))
+
+    def urls(self):
+        # 遍历队列中的所有链接（不出队）
+        for batch in self.url_batches():
+            for url in batch:
+                yield url
+
+    def url_batches(self, batch_size=10000):
+        # 分批遍历队列中的链接，每批一个短查询，不会长时间占着读事务
+        conn = self._connect()
+        last_id = 0
+        while True:
+            with self._thread_lock:
+                rows = conn.execute('SELECT id, url FROM frontier WHERE id > ? ORDER BY id LIMIT ?',
+                                    (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [url for _, url in rows]
+
+    def empty(self):
+        conn = self._connect()
+        return not self._buffer and conn.execute('SELECT 1 FROM frontier LIMIT 1').fetchone() is None
+
+    def __len__(self):
+        conn = self._connect()
+        return conn.execute('SELECT COUNT(*) FROM frontier').fetchone()[0] + len(self._buffer)
@@ -2,9 +2,15 @@
 # Created by FFJ on 20170822
 #
 # 依赖 lxml 库: pip install lxml
+# 抽取规则在 site_specs.py 里
 #
 # 按虎扑帖子 ID 顺序爬取纯文本数据， 每个帖子保存为一个 ID_帖子标题.txt 文件
 # ./ID.txt 存放从哪个 ID 开始爬，不存在则ID默认为 5000000
+# 多台机器一起爬时用 --coordinator 向同一个 ID 分配服务租 ID，见 id_coordinator.py
+# 已删除的帖子很多时用 --adaptive 先探测再爬，跳过的 ID 段记录在 ID 文件名.deferred 里，见 id_probe.py
+# --discover 先探测最大的有效帖子 ID，再从新到旧（--newest_first）或从某个百分位（--start_percentile）开始爬，见 id_discovery.py
+# 每个帖子逐页写进 .part 临时文件，全部写完才改名、追加到大文件，见 post_output.py
+# 大文件只由一个写入进程追加，爬虫进程通过队列把帖子交给它，见 output_writer.py
 #
 # 输出目录结构
 # --output
@@ -22,122 +28,218 @@
 
 import os
 import argparse
-from bs4 import BeautifulSoup
 from utils import *
+from extractor import Extractor
+from site_specs import SITE_SPECS
+from rate_limiter import HostRateLimiter
+from proxy_pool import ProxyPool, ApiProxySource, FileProxySource
+from async_engine import AsyncEngine
+from pipeline import PostPipeline
+from pagination import PageFetcher
+from post_output import PostOutput
+from output_writer import OutputWriter
+from id_lease import IdLeaseAllocator
+from id_coordinator import RemoteIdAllocator
+from id_probe import AdaptiveIdScheduler
+from id_discovery import IdSpaceProber, log_profile
 
-# 多进程锁
-m_lock = multiprocessing.Lock()
 
+# 抽取规则见 site_specs.py
+EXTRACTOR = Extractor(SITE_SPECS['hupu'])
 
-def get_title(html):
-    try:
-        soup = BeautifulSoup(html, 'lxml')
-        raw_title = soup.find('h1')
 
-        if not raw_title:
-            return ''
-        title = remove_html_tag(str(raw_title))
-        return title
-    except Exception as e:
-        logging.error('Get title: {}'.format(e))
-        return ''
+def get_title(html):
+    """
+    获取帖子标题
+    :param html: 网页源码或 extractor.Document
+    :return: 帖子标题
+    """
+    return EXTRACTOR.title(html)
 
 
 def get_posts_num(html):
-    try:
-        soup = BeautifulSoup(html, 'lxml')
-        raw_posts_num = soup.find('div', {'class': 'page'})
-        match = re.findall('/[0-9]+-[0-9]+.html', str(raw_posts_num))
-        if match:
-            last_num_url = match.pop(-2)
-            last_num = re.findall('-[0-9]+.html', str(last_num_url))
-            return int(last_num[0][1:-5])
-        else:
-            return 1
-    except Exception as e:
-        logging.error('Get posts num: '.format(e))
-        return 1
-
-
-# 暂时不需要
-def get_floor(content):
-    c_content = '<html><body>' + str(content) + '</html></body>'
-    try:
-        soup = BeautifulSoup(c_content, 'lxml')
-        raw_floor = soup.findAll('span', {'class': 'tail-info'})
-        f_floor = re.findall('[0-9]+楼', str(raw_floor))
-        if f_floor:
-            floor = remove_html_tag(str(f_floor[0]))
-            return str(floor)
-        else:
-            return ''
-    except Exception as e:
-        logging.error('Get floor: {}'.format(e))
-        return ''
+    """
+    获取帖子页数
+    :param html: 网页源码或 extractor.Document
+    :return: 帖子页数
+    """
+    return EXTRACTOR.page_count(html)
 
 
 def get_content(html):
-    try:
-        soup = BeautifulSoup(html, 'lxml')
-        extract = soup.find_all('blockquote')
-        extract.extend(soup.find_all('small'))
-        [i.extract() for i in extract]
-        raw = soup.find_all('div', {'class': 'quote-content'})
-        all_content = '\n\n'.join([re.sub('@.+?[\s]', '', remove_html_tag(str(c)).strip()) for c in raw])
-        return all_content
-    except Exception as e:
-        logging.error('Get content: {}'.format(e))
-        return ''
+    """
+    获取帖子正文内容
+    :param html: 网页源码或 extractor.Document
+    :return: 帖子正文
+    """
+    return EXTRACTOR.body(html)
+
+
+def parse_post_page(html):
+    """
+    解析帖子第一页，只建一次树
+    :param html: 网页源码
+    :return: (标题, 正文, 页数)
+    """
+    doc = EXTRACTOR.document(html)
+    title = get_title(doc)
+    if not title:
+        return title, '', 1
+    return title, get_content(doc), get_posts_num(doc)
 
 
 class Spider(object):
     def __init__(self):
-        self.list_url_queue = multiprocessing.Manager().list()
         self.seed_url = 'https://bbs.hupu.com/'
         self.post_id_file = args.output + '/temp_ID.txt'
         self.single_output_dir = args.output + '/'
         self.all_output_file = args.output + '.txt'
         self.deduplicate_all_file = args.output + '_deduplication.txt'
+        # 重试后仍然抓取失败的分页，每行 帖子ID\t网址
+        self.failed_pages_file = args.output + '_failed_pages.txt'
         self.proxies_file = 'all_proxies.txt'
-        self.post_id = int()
-
-        # 初始ID
-        self.start_id = args.id
 
         # 多进程数量
         self.process_num = args.n
-        # 一次放多少条帖子链接队列
-        self.queue_put_num = 10000
+        # 大文件只由这个写入进程追加，见 output_writer.py
+        self.output_writer = OutputWriter(args.write_buffer * 1024 * 1024, fsync_interval=args.fsync_interval)
+        # 每个帖子的第 2..N 页并发抓取，见 pagination.py
+        self.page_fetcher = PageFetcher(args.page_concurrency)
+        # 每个 host 的连接数至少要和同时抓取的线程数一样多，在 fork 之前设置一次，运行中不再重建 Session
+        configure_session(pool_maxsize=max(POOL_MAXSIZE, args.page_concurrency, args.fetch_workers))
+        if args.stream:
+            # 边下载边检查，被删的帖子、过大的和不是 HTML 的内容提前断开，规则见 site_specs.py 的 fetch
+            set_stream_limits(StreamLimits.from_site_spec(SITE_SPECS['hupu']))
+        # 探测也要发请求，先装好限速和代理池
+        self.init_network()
+        start_id = int(args.id)
+        if args.discover:
+            start_id = self.discover_start_id(start_id)
+        # 每个进程一次租一段连续的 ID，见 id_lease.py
+        if args.coordinator:
+            # 多台机器一起爬时向 ID 分配服务租，见 id_coordinator.py
+            self.id_allocator = RemoteIdAllocator(args.coordinator, args.block_size)
+        else:
+            self.id_allocator = IdLeaseAllocator(self.post_id_file, start_id, args.block_size, args.newest_first)
+        # 探测并跳过已删除帖子扎堆的 ID，见 id_probe.py
+        self.id_scheduler = None
+        if args.adaptive:
+            self.id_scheduler = AdaptiveIdScheduler(self.id_allocator, args.region_size, args.probe_rate,
+                                                    args.dense_density, self.post_id_file + '.deferred')
+        self.id_source = self.id_scheduler or self.id_allocator
+
+    def init_network(self):
+        # 限速和代理池在主进程里创建，--discover 的探测请求和 fork 出的爬虫进程都用它们
+        if args.rate:
+            set_rate_limiter(HostRateLimiter(args.rate, args.burst))
+        if args.proxy:
+            source = FileProxySource(args.proxy_file) if args.proxy_file else ApiProxySource()
+            proxy_pool = ProxyPool(source)
+            proxy_pool.refresh(force=True)
+            set_proxy_pool(proxy_pool)
 
     def init_post_id(self):
-        with m_lock:
-            if not os.path.exists(self.single_output_dir):
-                os.mkdir(self.single_output_dir)
-            if not os.path.exists(self.post_id_file):
-                with open(self.post_id_file, 'w') as fw:
-                    fw.write(self.start_id)
-
-            with open(self.post_id_file, 'r') as fr:
-                self.post_id = int(fr.read())
-
-            logging.warning('导入 {} 到队列'.format(str(self.post_id)))
-            for post_count in range(self.post_id, self.post_id + self.queue_put_num):
-                self.list_url_queue.append(post_count)
-
-            with open(self.post_id_file, 'w') as fw:
-                fw.write(str(self.post_id + self.queue_put_num))
+        # 创建输出目录
+        if not os.path.exists(self.single_output_dir):
+            os.mkdir(self.single_output_dir)
+
+    def next_post_id(self):
+        # 取下一个帖子 ID，从本进程租到的 ID 段里取，不需要进程间通信
+        return self.id_source.next_id()
+
+    def finish_post_id(self, post_id):
+        # 帖子处理完（无论是否保存），推进 ID 段的完成进度，重启时从这里接着爬
+        self.id_source.finish(post_id)
+
+    def probe_post(self, post_id):
+        # 是否是有效帖子，只看第一页的标题
+        html = get_html(self.first_page_url(post_id))
+        if not html:
+            return False
+        title = get_title(html)
+        return bool(title)
+
+    def discover_start_id(self, low):
+        """
+        探测当前最大的有效帖子 ID 和密度分布，决定从哪个 ID 开始爬，见 id_discovery.py
+        :param low: 从这个 ID 往上探测
+        :return: 起始 ID（--newest_first 时是第一段的结束 ID）
+        """
+        prober = IdSpaceProber(self.probe_post)
+        frontier = prober.find_frontier(low)
+        if frontier is None:
+            logging.error('{} 之后没有探测到有效帖子'.format(low))
+            return low
+        profile = prober.profile(low, frontier)
+        log_profile(profile)
+        logging.warning('最大的有效帖子 ID 为 {0}，探测用了 {1} 次请求'.format(frontier, prober.requests))
+
+        start_id = low
+        if args.newest_first:
+            start_id = frontier + 1
+        elif args.start_percentile:
+            start_id = prober.percentile_id(profile, args.start_percentile)
+        if args.coordinator:
+            logging.warning('ID 由分配服务决定，可以用 --id {} 启动 id_coordinator.py'.format(start_id))
+        elif os.path.exists(self.post_id_file):
+            logging.warning('{} 已存在，从上次的进度接着爬，不使用探测结果'.format(self.post_id_file))
+        else:
+            logging.warning('从 {} 开始爬'.format(start_id))
+        return start_id
+
+    def mark_failed_page(self, post_id, page_url):
+        # 重试后仍然失败的分页记录下来以后补爬，不要当作空白页跳过
+        logging.error('{0}: 分页抓取失败 {1}'.format(post_id, page_url))
+        self.output_writer.append(self.failed_pages_file, '{0}\t{1}\n'.format(post_id, page_url))
+
+    def first_page_url(self, post_id):
+        return '{0}{1}.html'.format(self.seed_url, str(post_id))
+
+    def other_page_url(self, post_id, page):
+        return '{0}{1}-{2}.html'.format(self.seed_url, str(post_id), str(page))
+
+    def check_first_page(self, post_url, post_title, first_page_content):
+        # 第一页是否值得继续爬其余页
+        if not post_title:
+            logging.error('找不到title: {}'.format(post_url))
+            return False
+        if not first_page_content:
+            logging.error('### 帖子无内容 ###: {}'.format(post_url))
+            return False
+        return True
+
+    def open_post(self, post_id, post_title):
+        # 开始保存一个帖子，各页正文逐页 write_page，全部写完后 commit_post，见 post_output.py
+        output_file = None
+        if not args.no_small_file:
+            post_id_prefix = str(post_id)[:-4]
+            if not post_id_prefix:
+                post_id_prefix = '0'
+            output_file_path = self.single_output_dir + str(post_id_prefix) + '/'
+            if not os.path.exists(output_file_path):
+                os.makedirs(output_file_path, exist_ok=True)
+            output_file = output_file_path + str(post_id) + '_' + safe_file_name(post_title) + '.txt'
+
+        return PostOutput(output_file,
+                          None if args.no_nondedu_file else self.all_output_file,
+                          None if args.no_dedu_file else self.deduplicate_all_file,
+                          writer=self.output_writer, separator='\n\n')
+
+    def commit_post(self, post_id, post_title, output, page_num):
+        # 一个帖子的各页都写完了，让小文件和大文件里的内容生效
+        output.commit()
+
+        if self.id_scheduler is not None:
+            self.id_scheduler.mark_live(post_id)
+
+        logging.warning('{0} ---{2}--- {1}'.format(post_id, safe_file_name(post_title), str(page_num)))
 
     def run(self):
         while True:
             try:
-                if not self.list_url_queue:
-                    self.init_post_id()
-
-                post_id = self.list_url_queue.pop(0)
-                post_id_prefix = str(post_id)[:-4]
-                if not post_id_prefix:
-                    post_id_prefix = '0'
-
+                post_id = self.next_post_id()
+                if post_id is None:
+                    break
                 post_url_without_suffix = '{0}{1}'.format(self.seed_url, str(post_id))
                 post_url = post_url_without_suffix + '.html'
 
@@ -145,66 +247,121 @@ class Spider(object):
                 logging.critical('取ID问题: {}'.format(e))
                 continue
 
+            # 正常处理完或者出了已知的错才推进完成进度
+            # Ctrl-C、SIGTERM 中断的帖子没有写完，不算完成，重启后会再爬
             try:
-                post_html = get_html(post_url)
-                if not post_html:
-                    continue
-                post_title = get_title(post_html)
-                if not post_title:
-                    logging.error('找不到title: {}'.format(post_url))
-                    continue
-                first_page_content = get_content(post_html)
-                if not first_page_content:
-                    logging.error('### 帖子无内容 ###: {}'.format(post_url))
-                    continue
-
-                all_content = first_page_content
-                page_num = get_posts_num(post_html)
-
-                for i in range(page_num):
-                    if i != 0:
-                        page_url = '{0}-{1}.html'.format(post_url_without_suffix, str(i + 1))
-                        other_page = get_html(page_url)
-                        other_content = get_content(other_page)
-                        all_content = all_content + '\n\n' + other_content
-
-                dr = re.compile(r'/|[\\]|[ ]|[|]|[:]|[*]|[<]|[>]|[?]|[\']|["]')
-                post_title = dr.sub('_', post_title)
-                
-                if not args.no_small_file:
-                    output_file_path = self.single_output_dir + str(post_id_prefix) + '/'
-                    if not os.path.exists(output_file_path):
-                        os.makedirs(output_file_path, exist_ok=True)
-                    output_file = output_file_path + str(post_id) + '_' + post_title + '.txt'
-                    save_content(output_file, all_content, mode='w')
-
-                if not args.no_nondedu_file:
-                    save_content(self.all_output_file, all_content, mode='a')
-
-                if not args.no_dedu_file:
-                    deduplicate_save_content(self.deduplicate_all_file, all_content)
-                logging.warning('{0} ---{2}--- {1}'.format(post_id, post_title, str(page_num)))
-
+                self.crawl_post(post_id, post_url)
             except Exception as e:
                 logging.critical('尚未预料到的错误: {0} | {1}'.format(e, post_url))
-                continue
+            self.finish_post_id(post_id)
+
+    def crawl_post(self, post_id, post_url):
+        # 处理一个帖子，不用保存时直接返回
+        post_html = get_html(post_url)
+        if not post_html:
+            return
+        post_title, first_page_content, page_num = parse_post_page(post_html)
+        if not post_title:
+            logging.error('找不到title: {}'.format(post_url))
+            return
+        if not first_page_content:
+            logging.error('### 帖子无内容 ###: {}'.format(post_url))
+            return
+
+        page_urls = [self.other_page_url(post_id, page) for page in range(2, page_num + 1)]
+        with self.open_post(post_id, post_title) as output:
+            output.write_page(first_page_content)
+            for page_url, content in zip(page_urls, self.page_fetcher.iter_pages(page_urls, get_content)):
+                if content is None:
+                    self.mark_failed_page(post_id, page_url)
+                output.write_page(content or '')
+            self.commit_post(post_id, post_title, output, page_num)
+
+    async def crawl_async(self, engine):
+        # 异步模式下处理一个帖子，解析在 engine 的进程池里执行
+        # 取 ID 和完成 ID 可能要加文件锁或者等 ID 分配服务，放到 engine 的线程池里
+        try:
+            post_id = await engine.call(self.next_post_id)
+        except Exception as e:
+            logging.critical('取ID问题: {}'.format(e))
+            return
+        if post_id is None:
+            return False
+        # 和 run 一样，被取消（CancelledError）或中断的帖子不算完成
+        try:
+            await self.crawl_post_async(engine, post_id)
+        except Exception as e:
+            logging.critical('尚未预料到的错误: {0} | {1}'.format(e, post_id))
+        await engine.call(self.finish_post_id, post_id)
+
+    async def crawl_post_async(self, engine, post_id):
+        post_url_without_suffix = '{0}{1}'.format(self.seed_url, str(post_id))
+        post_url = post_url_without_suffix + '.html'
+
+        post_html = await engine.get_html(post_url)
+        if not post_html:
+            return
+        post_title, first_page_content, page_num = await engine.parse(parse_post_page, post_html)
+        if not post_title:
+            logging.error('找不到title: {}'.format(post_url))
+            return
+        if not first_page_content:
+            logging.error('### 帖子无内容 ###: {}'.format(post_url))
+            return
+
+        page_urls = [self.other_page_url(post_id, page) for page in range(2, page_num + 1)]
+        # 写临时文件、改名和放进写入队列（队列满时等待）都会阻塞，放到 engine 的线程池里
+        output = await engine.call(self.open_post, post_id, post_title)
+        try:
+            await engine.call(output.write_page, first_page_content)
+            async for content in self.page_fetcher.iter_pages_async(engine, page_urls, get_content):
+                if content is None:
+                    await engine.call(self.mark_failed_page, post_id, page_urls[output.pages - 1])
+                await engine.call(output.write_page, content or '')
+            await engine.call(self.commit_post, post_id, post_title, output, page_num)
+        finally:
+            # 没有 commit 就退出时丢掉写了一半的内容，已经 commit 过时什么也不做
+            await engine.call(output.abort)
+
+    def run_async(self):
+        # 异步模式的进程函数
+        engine = AsyncEngine(args.async_concurrency, parse_workers=max(1, os.cpu_count() // self.process_num))
+        engine.run(self.crawl_async)
+
+    def run_pipeline(self):
+        # 流水线模式的进程函数：抓取线程、解析进程池、汇总写入线程分开执行
+        parse_workers = args.parse_workers or max(1, os.cpu_count() // self.process_num)
+        pipeline = PostPipeline(args.fetch_workers, parse_workers, page_concurrency=args.page_concurrency)
+        pipeline.run(self.next_post_id, self.first_page_url, self.other_page_url, parse_post_page, get_content,
+                     self.check_first_page, self.open_post, self.commit_post, finish_post_id=self.finish_post_id,
+                     failed_page=self.mark_failed_page)
 
     def start(self):
         self.init_post_id()
         time.sleep(3)
         processes = []
-        if args.proxy:
-            get_proxies = multiprocessing.Process(target=regularly_get_proxy, args=())
-            get_proxies.start()
-            processes.append(get_proxies)
-            time.sleep(3)
-        for i in range(self.process_num):
-            t = multiprocessing.Process(target=self.run, args=())
-            t.start()
-            processes.append(t)
-
-        for t in processes:
-            t.join()
+        if args.fetch_workers:
+            target = self.run_pipeline
+        elif args.async_concurrency:
+            target = self.run_async
+        else:
+            target = self.run
+        self.output_writer.start()
+        try:
+            for i in range(self.process_num):
+                t = multiprocessing.Process(target=target, args=())
+                t.start()
+                processes.append(t)
+
+            for t in processes:
+                t.join()
+        finally:
+            # Ctrl-C 时爬虫进程也会退出，等它们把已经 commit 的帖子放进队列，再让写入进程写完退出
+            try:
+                for t in processes:
+                    t.join()
+            finally:
+                self.output_writer.stop()
 
 
 if __name__ == '__main__':
@@ -216,6 +373,32 @@ if __name__ == '__main__':
     parser.add_argument('-n', help='多进程数量（默认为1）', type=int, default=1)
     parser.add_argument('--id', help='起始ID（默认为0）', type=str, default='0')
     parser.add_argument('--proxy', help='使用代理', action='store_true')
+    parser.add_argument('--proxy_file', help='代理列表文件，每行一个（默认通过API获取）', type=str, default='')
+    parser.add_argument('--async-concurrency', help='异步模式，每个进程同时在飞的请求数（默认不启用）',
+                        type=int, default=0)
+    parser.add_argument('--block_size', help='每个进程一次租多少个连续的ID（默认为1000）', type=int, default=1000)
+    parser.add_argument('--coordinator', help='ID 分配服务的地址，host:port 或 Unix socket 路径，'
+                                              '共享令牌放在环境变量 ID_COORDINATOR_TOKEN 里（默认使用本地ID文件）',
+                        type=str, default='')
+    parser.add_argument('--discover', help='先探测最大的有效帖子ID和密度分布，再决定从哪里开始爬', action='store_true')
+    parser.add_argument('--newest_first', help='从新到旧爬（和 --discover 一起用时从最大的有效帖子ID开始）',
+                        action='store_true')
+    parser.add_argument('--start_percentile', help='和 --discover 一起用，跳过最旧的百分之多少的有效帖子（默认为0）',
+                        type=float, default=0)
+    parser.add_argument('--adaptive', help='按有效帖子密度探测，跳过已删除帖子扎堆的ID段', action='store_true')
+    parser.add_argument('--region_size', help='探测时每组多少个ID（默认为100）', type=int, default=100)
+    parser.add_argument('--probe_rate', help='低密度时每组先探测的比例（默认为0.1）', type=float, default=0.1)
+    parser.add_argument('--dense_density', help='有效帖子比例不低于它时不探测（默认为0.2）', type=float, default=0.2)
+    parser.add_argument('--fetch_workers', help='流水线模式，每个进程的抓取线程数（默认不启用）', type=int, default=0)
+    parser.add_argument('--page_concurrency', help='每个帖子同时抓取的页数（默认为4）', type=int, default=4)
+    parser.add_argument('--parse_workers', help='流水线模式，每个进程的解析进程数（默认为 CPU 核数/进程数）',
+                        type=int, default=0)
+    parser.add_argument('--write_buffer', help='写入进程攒够多少MB写一次大文件（默认为4）', type=int, default=4)
+    parser.add_argument('--fsync_interval', help='写入进程每隔多少秒 fsync 一次大文件（默认为0，不主动 fsync）',
+                        type=float, default=0)
+    parser.add_argument('--stream', help='流式下载，出现被删帖子的提示语或内容过大时提前断开', action='store_true')
+    parser.add_argument('--rate', help='每个网站每秒最多请求数，所有进程共享（默认不限速）', type=float, default=0)
+    parser.add_argument('--burst', help='限速时允许的瞬时突发请求数（默认等于 rate）', type=float, default=0)
     parser.add_argument('--log', help='输出log到文件，否则输出到控制台', action='store_true')
     args = parser.parse_args()
 
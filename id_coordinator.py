@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-31
+#
+# 多台机器一起按 ID 爬取时的 ID 分配服务，代替各自机器上的 ID.txt
+# 每个爬虫进程向它租一段连续的 ID，和 id_lease.py 一样在本进程内逐个取
+#
+#   租约超时   进程定时报告租约的完成进度（同时续租），超过 timeout 秒没有报告的租约
+#              视为节点已经退出，下一次有进程来租时从它的完成进度接着分配出去
+#   状态保存   下一段的起始 ID 和所有租约定时写入 state 文件，服务重启后接着分配
+#   进度汇总   每个节点处理完的 ID 数、速度，定时输出到 log，也可以用 --status 查询
+#   从新到旧   --descending 时 --id 是第一段的结束 ID，每次往下分配一段，到 0 为止
+#
+# 协议: 一行 JSON 请求，一行 JSON 回复，每个请求都带上共享令牌 "token"
+#   {"cmd": "acquire", "node": ..., "size": ...}            -> {"start", "end", "done", "timeout"}，分配完时 start 为 null
+#   {"cmd": "progress", "node": ..., "start": ..., "done": ...} -> {"ok": 租约是否还属于这个节点}
+#   {"cmd": "status"}                                       -> 进度汇总
+#
+# 用法（令牌放在环境变量 ID_COORDINATOR_TOKEN 里，服务和所有节点用同一个）
+# export ID_COORDINATOR_TOKEN=一串随机字符
+# python3 id_coordinator.py 0.0.0.0:7000 --id 5000000000 --state coordinator.json
+# python3 tieba_spider.py output -n 8 --coordinator 192.168.1.10:7000
+# python3 id_coordinator.py 192.168.1.10:7000 --status
+#
+# 地址为 host:port 时使用 TCP，否则当作 Unix socket 文件路径
+# 没有令牌时只能监听 127.0.0.1 / localhost 或 Unix socket，任何能连上的人都能租 ID、推进进度
+
+import os
+import hmac
+import json
+import time
+import socket
+import logging
+import argparse
+import ipaddress
+import threading
+import socketserver
+
+from id_lease import IdLease
+
+# 共享令牌的环境变量
+TOKEN_ENV = 'ID_COORDINATOR_TOKEN'
+
+
+def parse_address(address):
+    """
+    :param address: host:port 或 Unix socket 文件路径
+    :return: (地址族, 地址)
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return socket.AF_INET, (host.strip('[]'), int(port))
+    return socket.AF_UNIX, address
+
+
+def is_local_address(address):
+    # 只有本机能连上的地址：Unix socket、回环地址
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        return True
+    host = addr[0]
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def check_token(expected, token):
+    # 没有设置令牌时不检查
+    if not expected:
+        return True
+    return isinstance(token, str) and hmac.compare_digest(expected.encode('utf-8'), token.encode('utf-8'))
+
+
+def request(address, message, timeout=10, token=None):
+    """
+    发送一个请求并等待回复，每个请求一个连接
+    :param address: 服务地址
+    :param message: 请求内容
+    :param timeout: 超时秒数
+    :param token: 共享令牌，默认取环境变量 ID_COORDINATOR_TOKEN
+    :return: 回复内容
+    """
+    if token is None:
+        token = os.environ.get(TOKEN_ENV, '')
+    message = dict(message, token=token)
+    family, addr = parse_address(address)
+    if family == socket.AF_INET:
+        sock = socket.create_connection(addr, timeout=timeout)
+    else:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(addr)
+    with sock:
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as fr:
+            line = fr.readline()
+    if not line:
+        raise ConnectionError('ID 分配服务没有回复')
+    reply = json.loads(line.decode('utf-8'))
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+    return reply
+
+
+class IdCoordinator(object):
+    """
+    租约状态，与网络无关
+    """
+
+    def __init__(self, start_id, block_size=1000, timeout=300, state_file=None, descending=False):
+        """
+        :param start_id: state 文件不存在时的起始 ID
+        :param block_size: 节点没有指定时每次租多少个 ID
+        :param timeout: 租约多少秒没有报告进度就收回
+        :param state_file: 保存状态的文件，为 None 时不保存
+        :param descending: 从新到旧分配
+        """
+        self.cursor = start_id
+        self.block_size = block_size
+        self.descending = descending
+        self.timeout = timeout
+        self.state_file = state_file
+        # {start: {'start', 'end', 'done', 'node', 'expires'}}
+        self.leases = {}
+        # {node: {'completed': 处理完的 ID 数, 'last_seen': 最后一次请求的时间}}
+        self.nodes = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        # 定时保存和退出时的保存不能同时写临时文件，旧的状态也不能覆盖新的
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        with open(self.state_file, 'r') as fr:
+            state = json.load(fr)
+        self.cursor = state['cursor']
+        # 给原来的节点一个超时时间重新报告，之后再收回
+        expires = time.time() + self.timeout
+        for lease in state['leases']:
+            lease['expires'] = expires
+            self.leases[lease['start']] = lease
+        logging.warning('载入 {0}，下一段从 {1} 开始，未完成的租约 {2} 段'.format(
+            self.state_file, self.cursor, len(self.leases)))
+
+    def save(self):
+        # 先写临时文件再改名，取状态、写文件、改名都在保存锁里，租约锁只在取状态时持有
+        if not self.state_file:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                state = {'cursor': self.cursor,
+                         'leases': [{k: lease[k] for k in ('start', 'end', 'done', 'node')}
+                                    for lease in self.leases.values()]}
+                self._dirty = False
+            try:
+                with open(self.state_file + '.tmp', 'w') as fw:
+                    json.dump(state, fw)
+                os.replace(self.state_file + '.tmp', self.state_file)
+            except Exception:
+                # 下次再保存
+                with self._lock:
+                    self._dirty = True
+                raise
+
+    def _touch(self, node, now):
+        record = self.nodes.setdefault(node, {'completed': 0, 'last_seen': now})
+        record['last_seen'] = now
+        return record
+
+    def acquire(self, node, size=None):
+        """
+        租一段 ID: 优先收回超时的租约，否则分配新的一段
+        :param node: 节点名
+        :param size: 这一段的长度
+        :return: 租约，没有可分配的 ID 时 start 为 None
+        """
+        now = time.time()
+        with self._lock:
+            self._touch(node, now)
+            expired = [lease for lease in self.leases.values() if lease['expires'] < now]
+            if expired:
+                lease = min(expired, key=lambda l: l['start'])
+                logging.warning('{0} 的 ID 段 {1}-{2} 超时，从 {3} 起交给 {4}'.format(
+                    lease['node'], lease['start'], lease['end'], lease['done'], node))
+            elif self.descending and self.cursor <= 0:
+                return {'start': None, 'end': None, 'done': None, 'timeout': self.timeout}
+            else:
+                if self.descending:
+                    end = self.cursor
+                    self.cursor = start = max(end - (size or self.block_size), 0)
+                else:
+                    start = self.cursor
+                    self.cursor = end = start + (size or self.block_size)
+                lease = {'start': start, 'end': end, 'done': start}
+                self.leases[start] = lease
+            lease['node'] = node
+            lease['expires'] = now + self.timeout
+            self._dirty = True
+            return {'start': lease['start'], 'end': lease['end'], 'done': lease['done'], 'timeout': self.timeout}
+
+    def progress(self, node, start, done):
+        """
+        节点报告一段租约的完成进度，同时续租
+        :param node: 节点名
+        :param start: 租约的起始 ID
+        :param done: 在它之前的 ID 都已处理完
+        :return: 租约是否还属于这个节点，超时被收回后返回 False
+        """
+        now = time.time()
+        with self._lock:
+            record = self._touch(node, now)
+            lease = self.leases.get(start)
+            if lease is None or lease['node'] != node:
+                return {'ok': False}
+            if done > lease['done']:
+                record['completed'] += done - lease['done']
+                lease['done'] = done
+                self._dirty = True
+            lease['expires'] = now + self.timeout
+            if lease['done'] >= lease['end']:
+                del self.leases[start]
+                self._dirty = True
+            return {'ok': True}
+
+    def status(self):
+        # 进度汇总
+        now = time.time()
+        with self._lock:
+            completed = sum(record['completed'] for record in self.nodes.values())
+            nodes = {}
+            for node, record in self.nodes.items():
+                nodes[node] = {'completed': record['completed'], 'leases': 0,
+                               'idle': round(now - record['last_seen'], 1)}
+            for lease in self.leases.values():
+                if lease['node'] in nodes:
+                    nodes[lease['node']]['leases'] += 1
+            return {'cursor': self.cursor,
+                    'leases': len(self.leases),
+                    'expired': sum(1 for lease in self.leases.values() if lease['expires'] < now),
+                    'lowest_done': min([lease['done'] for lease in self.leases.values()] or [self.cursor]),
+                    'completed': completed,
+                    'rate': round(completed / max(now - self.started_at, 1e-6), 2),
+                    'nodes': nodes}
+
+    def handle(self, message):
+        cmd = message.get('cmd')
+        if cmd == 'acquire':
+            return self.acquire(message['node'], message.get('size'))
+        if cmd == 'progress':
+            return self.progress(message['node'], message['start'], message['done'])
+        if cmd == 'status':
+            return self.status()
+        return {'error': '未知的请求 {}'.format(cmd)}
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line.decode('utf-8'))
+                if not check_token(self.server.token, message.get('token')):
+                    logging.error('令牌不对，拒绝来自 {} 的请求'.format(self.client_address or 'Unix socket'))
+                    reply = {'error': '令牌不对'}
+                else:
+                    reply = self.server.coordinator.handle(message)
+            except Exception as e:
+                logging.error('Coordinator request: {}'.format(e))
+                reply = {'error': str(e)}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class TCPCoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixCoordinatorServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, coordinator, token=''):
+    """
+    :param address: 监听地址
+    :param coordinator: IdCoordinator
+    :param token: 共享令牌，为空时只允许监听本机地址
+    :return: 还没开始 serve_forever 的服务
+    """
+    if not token and not is_local_address(address):
+        raise ValueError('监听 {0} 需要共享令牌（--token 或环境变量 {1}），否则任何人都能租 ID、推进进度'.format(
+            address, TOKEN_ENV))
+    family, addr = parse_address(address)
+    if family == socket.AF_INET:
+        server = TCPCoordinatorServer(addr, CoordinatorHandler)
+    else:
+        # 上次退出留下的 socket 文件
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = UnixCoordinatorServer(addr, CoordinatorHandler)
+    server.coordinator = coordinator
+    server.token = token
+    return server
+
+
+class RemoteIdAllocator(object):
+    """
+    向 ID 分配服务租 ID，接口和 id_lease.IdLeaseAllocator 相同
+    后台线程提前租好下一段、发送进度报告，next_id 和 finish 一般不需要等网络
+    （异步模式下它们在事件循环里调用，服务连不上时也不会卡住所有协程）
+    """
+
+    def __init__(self, address, block_size=1000, report_interval=5, token=None):
+        """
+        在主进程创建，fork 出的子进程各自租用
+        :param address: 服务地址
+        :param block_size: 每次租多少个 ID
+        :param report_interval: 每隔多少秒报告一次进度（不超过租约超时的三分之一）
+        :param token: 共享令牌，默认取环境变量 ID_COORDINATOR_TOKEN
+        """
+        self.address = address
+        self.token = token
+        self.block_size = block_size
+        self.report_interval = report_interval
+        self._lease = None
+        self._leases = {}
+        self._pid = None
+        self._thread_lock = threading.Lock()
+
+    @staticmethod
+    def node_name():
+        return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # 不要接着用父进程的租约；后台线程也不会随 fork 复制过来
+            self._lease = None
+            self._leases = {}
+            # 后台线程提前租好的下一段
+            self._spare = None
+            # 服务已经没有可分配的 ID
+            self._exhausted = False
+            # 整段完成、等待报告的租约
+            self._finished = []
+            self._spare_ready = threading.Condition(self._thread_lock)
+            self._wakeup = threading.Event()
+            self._wakeup.set()
+            self._pid = os.getpid()
+            threading.Thread(target=self._background_loop, daemon=True).start()
+
+    def acquire(self):
+        # 服务暂时连不上时一直重试，不要让爬虫进程退出
+        while True:
+            try:
+                reply = request(self.address, {'cmd': 'acquire', 'node': self.node_name(), 'size': self.block_size},
+                                token=self.token)
+                break
+            except (OSError, ValueError) as e:
+                logging.error('连接 ID 分配服务 {0} 失败: {1}'.format(self.address, e))
+                time.sleep(5)
+        self.report_interval = min(self.report_interval, reply['timeout'] / 3)
+        if reply['start'] is None:
+            return None
+        logging.warning('租到 ID 段 {0}-{1}，从 {2} 开始'.format(reply['start'], reply['end'], reply['done']))
+        return IdLease(reply['start'], reply['end'], reply['done'])
+
+    def next_id(self):
+        """
+        取本进程的下一个 ID，当前这段发完了换成后台线程租好的下一段
+        只有下一段还没租到时（刚启动或者服务连不上）才会等待
+        :return: ID，没有可分配的 ID 时返回 None
+        """
+        with self._thread_lock:
+            self._check_pid()
+            while True:
+                if self._lease is None:
+                    while self._spare is None and not self._exhausted:
+                        self._spare_ready.wait()
+                    if self._spare is None:
+                        return None
+                    self._lease, self._spare = self._spare, None
+                    # 让后台线程接着租下一段
+                    self._wakeup.set()
+                post_id = self._lease.take()
+                if post_id is not None:
+                    return post_id
+                self._lease = None
+
+    def finish(self, post_id):
+        """
+        一个 ID 处理完了（无论成功与否），推进所在租约的完成进度；整段完成时交给后台线程立即报告
+        :param post_id: ID
+        """
+        with self._thread_lock:
+            self._check_pid()
+            for lease in self._leases.values():
+                if lease.start <= post_id < lease.end:
+                    break
+            else:
+                return
+            if not lease.finish(post_id) or not lease.finished:
+                return
+            self._finished.append(lease)
+        self._wakeup.set()
+
+    def _report(self, lease):
+        try:
+            reply = request(self.address, {'cmd': 'progress', 'node': self.node_name(),
+                                           'start': lease.start, 'done': lease.done}, token=self.token)
+        except (OSError, ValueError) as e:
+            logging.error('报告进度失败: {}'.format(e))
+            return
+        with self._thread_lock:
+            if not reply['ok'] and not lease.finished:
+                # 超时后已经交给了别的节点，这一段剩下的 ID 不再处理
+                logging.warning('ID 段 {0}-{1} 已被收回'.format(lease.start, lease.end))
+                if self._lease is lease:
+                    self._lease = None
+                if self._spare is lease:
+                    self._spare = None
+                    self._wakeup.set()
+                self._leases.pop(lease.start, None)
+            elif lease.finished:
+                self._leases.pop(lease.start, None)
+
+    def _background_loop(self):
+        # 租下一段、报告整段完成的租约，定时报告所有租约的进度（同时续租）
+        last_report = time.time()
+        while True:
+            self._wakeup.wait(self.report_interval)
+            self._wakeup.clear()
+            try:
+                last_report = self._background_step(last_report)
+            except Exception as e:
+                # 线程不能退出，否则 next_id 会一直等下一段
+                logging.error('ID 分配后台线程: {}'.format(e))
+                time.sleep(1)
+                self._wakeup.set()
+
+    def _background_step(self, last_report):
+        with self._thread_lock:
+            need_spare = self._spare is None and not self._exhausted
+            finished, self._finished = self._finished, []
+        if need_spare:
+            lease = self.acquire()
+            with self._thread_lock:
+                if lease is None:
+                    self._exhausted = True
+                else:
+                    self._spare = lease
+                    self._leases[lease.start] = lease
+                self._spare_ready.notify_all()
+        for lease in finished:
+            self._report(lease)
+        if time.time() - last_report >= self.report_interval:
+            last_report = time.time()
+            with self._thread_lock:
+                leases = list(self._leases.values())
+            for lease in leases:
+                self._report(lease)
+        return last_report
+
+
+def print_status(address, token=None):
+    status = request(address, {'cmd': 'status'}, token=token)
+    print('下一段起始 ID {0}，未完成租约 {1} 段（超时 {2} 段），最小完成进度 {3}'.format(
+        status['cursor'], status['leases'], status['expired'], status['lowest_done']))
+    print('共处理 {0} 个 ID，{1} 个/秒'.format(status['completed'], status['rate']))
+    for node, record in sorted(status['nodes'].items()):
+        print('  {0}: 处理 {1} 个，租约 {2} 段，{3} 秒前报告'.format(
+            node, record['completed'], record['leases'], record['idle']))
+
+
+def log_status(coordinator, interval):
+    # 定时保存状态并输出进度
+    last_completed = 0
+    while True:
+        time.sleep(interval)
+        coordinator.save()
+        status = coordinator.status()
+        alive = sum(1 for record in status['nodes'].values() if record['idle'] < coordinator.timeout)
+        logging.warning('节点 {0} 个，未完成租约 {1} 段，共处理 {2} 个 ID，最近 {3:.1f} 个/秒，下一段从 {4} 开始'.format(
+            alive, status['leases'], status['completed'],
+            (status['completed'] - last_completed) / interval, status['cursor']))
+        last_completed = status['completed']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('address', help='监听地址，host:port 或 Unix socket 文件路径', type=str)
+    parser.add_argument('--id', help='起始ID（state 文件不存在时使用，默认为0）', type=int, default=0)
+    parser.add_argument('--block_size', help='节点没有指定时每次租多少个ID（默认为1000）', type=int, default=1000)
+    parser.add_argument('--timeout', help='租约多少秒没有报告进度就收回（默认为300）', type=float, default=300)
+    parser.add_argument('--state', help='保存分配状态的文件（默认不保存）', type=str, default='')
+    parser.add_argument('--interval', help='每隔多少秒保存状态并输出进度（默认为10）', type=float, default=10)
+    parser.add_argument('--descending', help='从新到旧分配，--id 是第一段的结束ID', action='store_true')
+    parser.add_argument('--status', help='查询指定地址上的服务的进度后退出', action='store_true')
+    parser.add_argument('--token', help='共享令牌（默认取环境变量 ID_COORDINATOR_TOKEN），监听非本机地址时必须设置',
+                        type=str, default=os.environ.get(TOKEN_ENV, ''))
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s|PID:%(process)d|%(levelname)s: %(message)s', level=logging.WARNING)
+
+    if args.status:
+        print_status(args.address, args.token)
+    else:
+        coordinator = IdCoordinator(args.id, args.block_size, args.timeout, args.state or None, args.descending)
+        try:
+            server = make_server(args.address, coordinator, args.token)
+        except ValueError as e:
+            parser.error(str(e))
+        threading.Thread(target=log_status, args=(coordinator, args.interval), daemon=True).start()
+        logging.warning('ID 分配服务监听 {}'.format(args.address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            coordinator.save()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-02-02
+#
+# 找出当前最大的有效帖子 ID（前沿），以及 ID 空间里有效帖子的密度分布
+# 用来决定从哪里开始爬，代替写死的 --id 默认值
+#
+#   前沿   从起始 ID 开始按 window, 2*window, 4*window ... 的间隔往上探测，
+#          连续 confirm 个点都没有有效帖子就认为越过了前沿，再在最后一个有效点和第一个无效点之间二分
+#   密度   把 [起始ID, 前沿] 平均分成 points 段，每段随机抽 samples 个 ID
+#
+# 每个点随机抽 samples 个 ID 探测，全部无效时再抽（最多 rounds 轮），避免稀疏区域被当成前沿之后
+# 探测函数由各个爬虫提供: post_id -> 是否是有效帖子
+#
+# 用 bench_discover.py 在本地的模拟 ID 空间上测试
+
+import random
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class IdSpaceProber(object):
+
+    def __init__(self, is_live, window=1000, samples=20, rounds=3, confirm=5, workers=8):
+        """
+        :param is_live: post_id -> 是否是有效帖子
+        :param window: 每个探测点的 ID 范围，也是二分结束时的精度
+        :param samples: 每个探测点每轮抽多少个 ID
+        :param rounds: 每个探测点最多抽几轮
+        :param confirm: 连续多少个探测点无效才认为越过了前沿
+        :param workers: 同时探测的线程数
+        """
+        self.is_live = is_live
+        self.window = window
+        self.samples = samples
+        self.rounds = rounds
+        self.confirm = confirm
+        self.workers = workers
+        # 探测过的 ID 数
+        self.requests = 0
+        # 探测到的最大有效帖子 ID
+        self.highest = None
+
+    def _probe_many(self, post_ids):
+        # 并发探测，返回其中的有效帖子
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = list(pool.map(self._safe_is_live, post_ids))
+        self.requests += len(post_ids)
+        live = [post_id for post_id, ok in zip(post_ids, results) if ok]
+        if live and (self.highest is None or max(live) > self.highest):
+            self.highest = max(live)
+        return live
+
+    def _safe_is_live(self, post_id):
+        try:
+            return self.is_live(post_id)
+        except Exception as e:
+            logging.error('Probe {0}: {1}'.format(post_id, e))
+            return False
+
+    def window_live(self, start):
+        """
+        :param start: 探测点
+        :return: [start, start + window) 中探测到的有效帖子，为空说明这里没有（或极少）有效帖子
+        """
+        candidates = list(range(start, start + self.window))
+        random.shuffle(candidates)
+        for i in range(self.rounds):
+            batch = candidates[i * self.samples:(i + 1) * self.samples]
+            if not batch:
+                break
+            live = self._probe_many(batch)
+            if live:
+                return live
+        return []
+
+    def find_frontier(self, low, max_id=10 ** 13):
+        """
+        :param low: 起始 ID，应该不大于前沿
+        :param max_id: 最多探测到这里
+        :return: 探测到的最大有效帖子 ID，一个都没有时返回 None
+        """
+        lo = low
+        hi = None
+        step = self.window
+        dead_run = 0
+        while low + step < max_id:
+            point = low + step
+            live = self.window_live(point)
+            logging.warning('探测 {0}: {1}'.format(point, '有效' if live else '无效'))
+            if live:
+                lo = point
+                hi = None
+                dead_run = 0
+            else:
+                if hi is None:
+                    hi = point
+                dead_run += 1
+                if dead_run >= self.confirm:
+                    break
+            step *= 2
+        if hi is None:
+            hi = min(low + step, max_id)
+
+        while hi - lo > self.window:
+            mid = (lo + hi) // 2
+            live = self.window_live(mid)
+            logging.warning('二分 {0}-{1}，探测 {2}: {3}'.format(lo, hi, mid, '有效' if live else '无效'))
+            if live:
+                lo = mid
+            else:
+                hi = mid
+        # 前沿附近多看一个窗口
+        self.window_live(lo)
+        return self.highest
+
+    def profile(self, low, high, points=20):
+        """
+        :param low: 起始 ID
+        :param high: 前沿
+        :param points: 分多少段
+        :return: [(段起始ID, 段结束ID, 有效帖子比例), ...]
+        """
+        points = max(1, min(points, high - low + 1))
+        bounds = [low + (high + 1 - low) * i // points for i in range(points + 1)]
+        result = []
+        for start, end in zip(bounds, bounds[1:]):
+            count = min(self.samples * self.rounds, end - start)
+            live = self._probe_many(random.sample(range(start, end), count))
+            result.append((start, end, len(live) / count))
+        return result
+
+    @staticmethod
+    def percentile_id(profile, percentile):
+        """
+        :param profile: profile() 的结果
+        :param percentile: 百分比
+        :return: 在它之前的有效帖子约占全部有效帖子的 percentile% 的 ID
+        """
+        weights = [(end - start) * density for start, end, density in profile]
+        total = sum(weights)
+        if not total:
+            return profile[0][0]
+        target = total * percentile / 100
+        cumulative = 0
+        for (start, end, density), weight in zip(profile, weights):
+            if weight and cumulative + weight >= target:
+                return start + int((end - start) * (target - cumulative) / weight)
+            cumulative += weight
+        return profile[-1][1]
+
+
+def log_profile(profile):
+    # 按段输出密度和累计的有效帖子比例
+    weights = [(end - start) * density for start, end, density in profile]
+    total = sum(weights) or 1
+    cumulative = 0
+    for (start, end, density), weight in zip(profile, weights):
+        cumulative += weight
+        logging.warning('{0:>14} - {1:<14} 密度 {2:.3f}  累计 {3:5.1f}%'.format(
+            start, end, density, cumulative * 100 / total))
+    logging.warning('估计有效帖子 {:.0f} 个'.format(sum(weights)))
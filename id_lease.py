@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-30
+#
+# 按顺序 ID 爬取的爬虫（贴吧、虎扑、天涯）的 ID 分配
+# 每个进程一次租一段连续的 ID，在本进程内逐个取，取 ID 不需要进程间通信
+#
+# 文件
+#   ID.txt           下一段未分配的起始 ID（与旧版本兼容）
+#   ID.txt.lock      分配时加的文件锁
+#   ID.txt.leases/   每段租约一个文件 {start, end, done, run_id, pid}
+#                    done 之前的 ID 都已处理完，由持有租约的进程自己更新，整段完成后删除
+#                    每处理完 sync_every 个 ID 或隔 sync_interval 秒才写一次，不是每个 ID 都写文件
+#
+# 重启或者某个进程退出后，没完成的租约从记录的 done 接着爬，不会跳过 ID
+# （上次写文件之后处理完的 ID 会再爬一次）
+#
+# descending=True 时从新到旧分配: ID.txt 是已分配到的最小 ID，每次租它下面的一段，到 0 为止
+# （每段之内仍然从小到大）
+
+import os
+import json
+import uuid
+import time
+import fcntl
+import logging
+import threading
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class IdLease(object):
+    """
+    一段 [start, end) 的 ID，done 之前的都处理完了
+    """
+
+    def __init__(self, start, end, done=None):
+        self.start = start
+        self.end = end
+        self.done = start if done is None else done
+        # 下一个要发出去的 ID
+        self.next_id = self.done
+        # 已经发出去、还没处理完的 ID
+        self.in_flight = set()
+        # 上次写进租约文件的 done 和时间
+        self.saved_done = self.done
+        self.saved_time = 0
+
+    def take(self):
+        # 取下一个 ID，这段用完返回 None
+        if self.next_id >= self.end:
+            return None
+        post_id = self.next_id
+        self.next_id += 1
+        self.in_flight.add(post_id)
+        return post_id
+
+    def finish(self, post_id):
+        """
+        :param post_id: 处理完的 ID
+        :return: done 是否前进了
+        """
+        self.in_flight.discard(post_id)
+        done = min(self.in_flight) if self.in_flight else self.next_id
+        if done == self.done:
+            return False
+        self.done = done
+        return True
+
+    @property
+    def finished(self):
+        return self.done >= self.end
+
+    def to_dict(self):
+        return {'start': self.start, 'end': self.end, 'done': self.done}
+
+
+class IdLeaseAllocator(object):
+
+    def __init__(self, cursor_file, start_id, block_size=1000, descending=False, sync_every=100, sync_interval=5):
+        """
+        在主进程创建，fork 出的子进程各自租用
+        :param cursor_file: 记录下一段起始 ID 的文件
+        :param start_id: 文件不存在时的起始 ID
+        :param block_size: 每次租多少个 ID
+        :param descending: 从新到旧分配，start_id 是第一段的结束 ID（不包含）
+        :param sync_every: done 前进多少个 ID 写一次租约文件
+        :param sync_interval: 最多隔多少秒写一次租约文件
+        """
+        self.cursor_file = cursor_file
+        self.lock_file = cursor_file + '.lock'
+        self.lease_dir = cursor_file + '.leases'
+        self.block_size = block_size
+        self.descending = descending
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        # 同一次运行的所有进程共用，用来识别上次运行留下的租约
+        self.run_id = uuid.uuid4().hex
+        # 本进程正在发放 ID 的租约
+        self._lease = None
+        # 本进程持有的所有租约 {start: IdLease}，已发完但还有 ID 在处理中的也在里面
+        self._leases = {}
+        self._pid = os.getpid()
+        # 流水线模式下取 ID 和完成 ID 在不同线程
+        self._thread_lock = threading.Lock()
+
+        os.makedirs(self.lease_dir, exist_ok=True)
+        if not os.path.exists(cursor_file):
+            with open(cursor_file, 'w') as fw:
+                fw.write(str(start_id))
+
+    def _lease_path(self, lease):
+        return os.path.join(self.lease_dir, '{}.json'.format(lease.start))
+
+    def _write_lease(self, lease):
+        # 先写临时文件再改名，进程中途退出也不会留下写了一半的文件
+        path = self._lease_path(lease)
+        record = lease.to_dict()
+        record.update({'run_id': self.run_id, 'pid': os.getpid()})
+        with open(path + '.tmp', 'w') as fw:
+            json.dump(record, fw)
+        os.replace(path + '.tmp', path)
+        lease.saved_done = lease.done
+        lease.saved_time = time.time()
+
+    def _is_orphan(self, record):
+        # 上次运行留下的，或者持有它的进程已经退出
+        return record.get('run_id') != self.run_id or not _pid_alive(record.get('pid', 0))
+
+    def acquire(self):
+        """
+        租一段 ID: 优先接手没人负责的未完成租约，否则从 ID.txt 分配新的一段
+        :return: IdLease，从新到旧分配到 0 时返回 None
+        """
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                names = [n for n in os.listdir(self.lease_dir) if n.endswith('.json')]
+                for name in sorted(names, key=lambda n: int(n[:-5])):
+                    try:
+                        with open(os.path.join(self.lease_dir, name), 'r') as fr:
+                            record = json.load(fr)
+                    except (OSError, ValueError):
+                        continue
+                    if self._is_orphan(record):
+                        lease = IdLease(record['start'], record['end'], record['done'])
+                        self._write_lease(lease)
+                        logging.warning('接手未完成的 ID 段 {0}-{1}，从 {2} 继续'.format(
+                            lease.start, lease.end, lease.done))
+                        return lease
+
+                with open(self.cursor_file, 'r') as fr:
+                    cursor = int(fr.read())
+                if self.descending:
+                    if cursor <= 0:
+                        return None
+                    lease = IdLease(max(cursor - self.block_size, 0), cursor)
+                    cursor = lease.start
+                else:
+                    lease = IdLease(cursor, cursor + self.block_size)
+                    cursor = lease.end
+                self._write_lease(lease)
+                with open(self.cursor_file + '.tmp', 'w') as fw:
+                    fw.write(str(cursor))
+                os.replace(self.cursor_file + '.tmp', self.cursor_file)
+                logging.warning('分配 ID 段 {0}-{1}'.format(lease.start, lease.end))
+                return lease
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # 不要接着用父进程的租约
+            self._lease = None
+            self._leases = {}
+            self._pid = os.getpid()
+
+    def next_id(self):
+        """
+        取本进程的下一个 ID，当前这段发完了再租一段
+        :return: ID，没有可分配的 ID 时返回 None
+        """
+        with self._thread_lock:
+            self._check_pid()
+            while True:
+                if self._lease is None:
+                    lease = self.acquire()
+                    if lease is None:
+                        return None
+                    self._lease = lease
+                    self._leases[self._lease.start] = self._lease
+                post_id = self._lease.take()
+                if post_id is not None:
+                    return post_id
+                # 还有 ID 没处理完的由 finish() 收尾
+                if self._lease.finished:
+                    self._release(self._lease)
+                self._lease = None
+
+    def finish(self, post_id):
+        """
+        一个 ID 处理完了（无论成功与否），推进所在租约的完成进度
+        :param post_id: ID
+        """
+        with self._thread_lock:
+            self._check_pid()
+            for lease in self._leases.values():
+                if lease.start <= post_id < lease.end:
+                    break
+            else:
+                return
+            if not lease.finish(post_id):
+                return
+            if lease.finished and lease is not self._lease:
+                self._release(lease)
+            elif (lease.done - lease.saved_done >= self.sync_every or
+                  time.time() - lease.saved_time >= self.sync_interval):
+                self._write_lease(lease)
+
+    def _release(self, lease):
+        # 整段完成，删除租约文件
+        self._leases.pop(lease.start, None)
+        try:
+            os.remove(self._lease_path(lease))
+        except OSError:
+            pass
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-02-01
+#
+# 按 ID 爬取时跳过大段已删除的帖子
+#
+# 把 ID 按 region_size 个一组（区域）交给爬虫，最近的区域里有效帖子的比例（密度）够高时整组照常爬
+# 密度低时先按间隔抽几个 ID 探测，探测中有一个是有效帖子就爬完这一组（有效帖子一般扎堆出现），
+# 否则跳过这一组剩下的 ID，整组按连续的段写进 deferred 文件（起始ID 结束ID 探测数，段里包括探测过的 ID），
+# 以后可以再补爬
+#
+# 探测的 ID 本身就是正常爬取，不会多发请求；取 ID 不会阻塞，探测结果没出来之前接着发下一组的 ID
+# ID 分配完之后不再等探测结果，还没决定的组剩下的 ID 直接发出去，next_id 返回 None 时确实没有 ID 要爬了
+# 每个进程单独估计密度，定时输出 每千次请求得到的有效帖子数
+
+import os
+import math
+import logging
+import threading
+
+from utils import save_content
+
+
+class Region(object):
+    """
+    一组连续取到的 ID
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        # 还没发出去的 ID
+        self.pending = []
+        # 已经发出去、还没处理完的探测 ID，为空说明已经决定要不要爬完这一组
+        self.probes = set()
+        self.probed = 0
+        self.live = 0
+        # 还没处理完的 ID 数
+        self.unfinished = len(ids)
+
+
+class AdaptiveIdScheduler(object):
+
+    def __init__(self, allocator, region_size=100, probe_rate=0.1, dense_density=0.2,
+                 deferred_file=None, report_every=1000):
+        """
+        在主进程创建，fork 出的子进程各自估计密度
+        :param allocator: IdLeaseAllocator 或 RemoteIdAllocator
+        :param region_size: 每组多少个 ID
+        :param probe_rate: 低密度时每组探测的比例
+        :param dense_density: 密度不低于它时不探测，整组照常爬
+        :param deferred_file: 记录跳过的 ID 的文件，为 None 时不记录
+        :param report_every: 每处理多少个 ID 输出一次统计
+        """
+        self.allocator = allocator
+        self.region_size = region_size
+        self.probe_count = max(2, int(math.ceil(region_size * probe_rate)))
+        self.dense_density = dense_density
+        self.deferred_file = deferred_file
+        self.report_every = report_every
+        self._pid = None
+        self._thread_lock = threading.Lock()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            # 没有数据之前当作密集区域
+            self.density = 1.0
+            # 可以直接发出去的 ID
+            self._ready = []
+            # {post_id: Region}
+            self._regions = {}
+            # 保存了的帖子
+            self._live = set()
+            self.requests = 0
+            self.finished = 0
+            self.live_posts = 0
+            self.skipped = 0
+
+    def _new_region(self):
+        ids = []
+        for _ in range(self.region_size):
+            post_id = self.allocator.next_id()
+            if post_id is None:
+                break
+            ids.append(post_id)
+        if not ids:
+            return False
+        region = Region(ids)
+        for post_id in region.ids:
+            self._regions[post_id] = region
+        if self.density >= self.dense_density:
+            self._ready.extend(region.ids)
+            return True
+        # 等间隔抽样探测，剩下的等探测结果
+        probe_count = min(self.probe_count, len(region.ids))
+        stride = len(region.ids) / probe_count
+        probes = [region.ids[int(i * stride)] for i in range(probe_count)]
+        region.probes = set(probes)
+        region.pending = [post_id for post_id in region.ids if post_id not in region.probes]
+        self._ready.extend(probes)
+        return True
+
+    def next_id(self):
+        """
+        :return: 下一个要爬的 ID，没有可分配的 ID 时返回 None
+        """
+        with self._thread_lock:
+            self._check_pid()
+            if not self._ready and not self._new_region():
+                # 取 ID 的一方拿到 None 就停了，之后才决定要爬的 ID 就没人爬了
+                self._release_pending()
+                if not self._ready:
+                    return None
+            post_id = self._ready.pop(0)
+            self.requests += 1
+            return post_id
+
+    def mark_live(self, post_id):
+        # 帖子有效（已保存），在 finish 之前调用
+        with self._thread_lock:
+            self._check_pid()
+            self._live.add(post_id)
+
+    def finish(self, post_id):
+        """
+        一个 ID 处理完了（无论成功与否）
+        :param post_id: ID
+        """
+        with self._thread_lock:
+            self._check_pid()
+            region = self._regions.pop(post_id, None)
+            live = post_id in self._live
+            self._live.discard(post_id)
+            self.finished += 1
+            if live:
+                self.live_posts += 1
+            if region is not None:
+                region.unfinished -= 1
+                if live:
+                    region.live += 1
+                if post_id in region.probes:
+                    region.probed += 1
+                    region.probes.discard(post_id)
+                    if not region.probes:
+                        self._decide(region)
+                if region.unfinished == 0:
+                    self._learn(region.live / len(region.ids))
+            report = self.finished % self.report_every == 0
+        self.allocator.finish(post_id)
+        if report:
+            self._report()
+
+    def _release_pending(self):
+        # ID 已经分配完，还在等探测结果的组不再等，剩下的 ID 全部发出去
+        regions = sorted(set(self._regions.values()), key=lambda region: region.ids[0])
+        for region in regions:
+            self._ready.extend(region.pending)
+            region.pending = []
+
+    def _decide(self, region):
+        # 探测都处理完了：有有效帖子就爬完，否则跳过剩下的
+        if region.live:
+            self._ready.extend(region.pending)
+            return
+        skipped, region.pending = region.pending, []
+        self.skipped += len(skipped)
+        region.unfinished -= len(skipped)
+        for post_id in skipped:
+            self._regions.pop(post_id, None)
+            self.allocator.finish(post_id)
+        if self.deferred_file and skipped:
+            # 探测过的 ID 也是无效帖子，和跳过的 ID 合在一起记录，一组一般只有一段
+            # 一组 ID 可能跨两个租约，按连续的段记录
+            runs = []
+            for post_id in sorted(region.ids):
+                if runs and runs[-1][1] == post_id:
+                    runs[-1][1] = post_id + 1
+                else:
+                    runs.append([post_id, post_id + 1])
+            save_content(self.deferred_file, ''.join('{0}\t{1}\t{2}\n'.format(start, end, region.probed)
+                                                     for start, end in runs), mode='a')
+
+    def _learn(self, density, alpha=0.3):
+        # 最近的区域权重更大
+        self.density = alpha * density + (1 - alpha) * self.density
+
+    def _report(self):
+        logging.warning('请求 {0} 个 ID，有效帖子 {1} 个，每千次请求 {2:.1f} 个，跳过 {3} 个 ID，当前密度 {4:.3f}'.format(
+            self.requests, self.live_posts, self.live_posts * 1000 / max(self.requests, 1), self.skipped,
+            self.density))
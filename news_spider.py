@@ -7,8 +7,8 @@
 #
 #
 # 修改 get_html() 中的 decode() 编码方式以获取HTML （一般是 utf-8 或 gbk ）
-# 修改 get_content() 以匹配需要爬取的网站的正文所在标签
-# 修改 get_all_links() 的 matches 以匹配需要的特定URL
+# 修改 site_specs.py 中对应网站的 body 以匹配需要爬取的网站的正文所在标签
+# 修改 site_specs.py 中对应网站的 links 以匹配需要的特定URL
 #
 # 修改 Spider().__init__() 中的种子URL、链接库文件名、输出文件名
 #
@@ -19,52 +19,48 @@
 
 
 import os
+import sys
+import signal
+import asyncio
 import argparse
-from bs4 import BeautifulSoup
+import threading
 from utils import *
+from extractor import Extractor
+from site_specs import SITE_SPECS
+from rate_limiter import HostRateLimiter
+from async_engine import AsyncEngine
+from url_set import SharedUrlSet, BloomUrlSet
+from frontier import SqliteFrontier
+from url_canon import Canonicalizer
 
 # 多进程的锁
 m_lock = multiprocessing.Lock
 
 
+# 抽取规则见 site_specs.py
+EXTRACTOR = Extractor(SITE_SPECS['163'])
+CANONICALIZER = Canonicalizer(SITE_SPECS['163'].get('canonical'))
+
+
 def get_content(html):
     # 获取HTML中需要的正文文本
-    # 根据每个网站的源码规则来定制
-    try:
-        soup = BeautifulSoup(html, 'lxml')
-        raw_content = soup.find_all('div', {'class': 'overview'})
-        raw_content.append(soup.find_all('div', {'class': 'post_text'}))
-        raw_content = re.sub('<!--开始-->[\s\S]+<!--结束-->|<!--\[if[\s\S]+<!\[endif\]-->|' +
-                             '<style[\s\S]+</style>|<script[\s\S]+</script>', '', str(raw_content))
-        s = '<html><body>{}</body></html>'.format(raw_content)
-        soup2 = BeautifulSoup(s, 'lxml')
-        content = ''
-        for i in soup2.find_all('p'):
-            i = remove_html_tag(str(i))
-            content += i.strip()
-        if content:
-            return content
-        else:
-            return ''
-    except Exception as e:
-        logging.error('Get content: {}'.format(e))
-        return ''
+    return EXTRACTOR.body(html)
 
 
 def get_all_links(html):
     # 匹配出HTML中的所有需要的链接
     try:
-        # matches = re.findall('"((http|ftp)s?://.*?)"', html)
-        matches = re.findall('http://\S+?html', html)
-        links = []
-        for i in matches:
-            links.append(i)
-        return links
+        return EXTRACTOR.links(html)
     except Exception as e:
         logging.error('Get all links: {}'.format(e))
         return []
 
 
+def parse_page(html):
+    # 一次取出正文和链接，异步模式下整个网页只需要传给解析进程一次
+    return get_content(html), get_all_links(html)
+
+
 class Spider(object):
 
     def __init__(self):
@@ -76,50 +72,67 @@ class Spider(object):
 
         # 种子URL
         self.seed_url = 'http://{}.163.com/'.format(self.prefix)
-        # 链接库文件
+        # 旧版本的链接库文件，启动时导入待爬队列
         self.links_base_file = args.output + '/temp_{}_163_links_base.txt'.format(self.prefix)
         # 已经爬过的链接库文件
         self.crawled_link_file = args.output + '/temp_{}_163_crawled_links'.format(self.prefix)
+        # 已爬链接按批写入
+        self.crawled_links_writer = BufferedAppender(self.crawled_link_file, encoding=None)
         # 输出文件
         self.output_file = args.output + '/{}_163.txt'.format(self.prefix)
 
-        # 等待爬取的链接队列
-        # 因为 multiprocessing.Queue() 最大容量只有三万多条，用 Manager().list() 代替
-        self.link_queue = multiprocessing.Manager().list()
+        # 等待爬取的链接队列，保存在 SQLite 文件里，所有进程共享
+        self.frontier = SqliteFrontier(args.output + '/temp_{}_163_frontier.db'.format(self.prefix))
 
-        # 爬过的链接列表，用于去重
-        self.crawled_links_list = multiprocessing.Manager().list()
+        # 布隆过滤器文件
+        self.seen_links_file = args.output + '/temp_{}_163_seen_links.bloom'.format(self.prefix)
+
+        # 见过的链接（已爬或已入队），所有进程共享，用于去重
+        if args.dedup == 'bloom':
+            self.seen_links = BloomUrlSet(args.seen_capacity, args.bloom_error_rate, self.seen_links_file)
+        else:
+            self.seen_links = SharedUrlSet(args.seen_capacity)
 
     def load_links(self):
-        # 载入link到内存
-        try:
-            if os.path.exists(self.crawled_link_file):
-                with open(self.crawled_link_file, 'r') as fr:
-                    for line in fr:
-                        line = line.strip()
-                        self.crawled_links_list.append(line)
-        except Exception as e:
-            logging.error('Load links to crawled list: {}'.format(e))
+        # 恢复去重集合: 已爬的链接 + 队列里待爬的链接，都是按批流式读取，耗时和链接数成正比
+        # 从文件恢复的布隆过滤器里已经都有了，不用再载入
+        start_time = time.time()
+        if not self.seen_links.restored:
+            try:
+                for batch in read_lines_in_batches(self.crawled_link_file, name='已爬链接'):
+                    self.seen_links.add_many(batch)
+            except Exception as e:
+                logging.error('Load links to crawled list: {}'.format(e))
 
+            try:
+                count = 0
+                for batch in self.frontier.url_batches():
+                    self.seen_links.add_many(batch)
+                    count += len(batch)
+                logging.warning('载入待爬链接完成: {} 条'.format(count))
+            except Exception as e:
+                logging.error('Load links in frontier: {}'.format(e))
+
+        # 旧版本的链接库文件，导入队列后改名，只导入一次
         try:
             if os.path.exists(self.links_base_file):
-                with open(self.links_base_file, 'r') as fr:
-                    for line in fr:
-                        line = line.strip()
-                        if line not in self.crawled_links_list:
-                            if line not in self.link_queue:
-                                self.link_queue.append(line)
+                for batch in read_lines_in_batches(self.links_base_file, name='旧链接库'):
+                    self.frontier.push_many(self.seen_links.add_many(batch))
+                self.frontier.flush()
+                os.rename(self.links_base_file, self.links_base_file + '.imported')
         except Exception as e:
             logging.error('Load links to Queue: {}'.format(e))
 
-        if not self.link_queue:
-            self.link_queue.append(self.seed_url)
-        logging.warning("Load links success")
+        logging.warning('Load links success: 去重集合 {0} 条, 用时 {1:.1f} 秒'.format(
+            len(self.seen_links), time.time() - start_time))
 
     def save_content(self, html):
         # 保存正文文本到 ./output_file
+        return self.write_content(get_content(html))
+
+    def write_content(self, content):
+        # 保存已经解析出的正文文本到 ./output_file
         try:
-            content = get_content(html)
             if content:
                 with open(self.output_file, 'a') as fw:
                     fw.write('{}\n'.format(content))
@@ -130,26 +143,22 @@ class Spider(object):
             return False
 
     def save_crawled_links(self, link):
-        # 保存已经抓取的link到 ./crawled_link_file
+        # 保存已经抓取的link到 ./crawled_link_file，先缓冲，攒一批再写
         try:
-            with open(self.crawled_link_file, 'a') as fw:
-                fw.write(link + '\n')
+            self.crawled_links_writer.write(link + '\n')
         except Exception as e:
             logging.error('Save crawled link：{}'.format(e))
 
     def save_all_links(self, html):
-        # 获取页面所有匹配的link并保存到 ./links_base_file
+        # 获取页面所有匹配的link并加入待爬队列
+        return self.save_links(get_all_links(html))
+
+    def save_links(self, all_links):
+        # 把已经匹配出的新link加入待爬队列，整页的链接一次去重、一次入队
         try:
-            all_links = get_all_links(html)
-            with open(self.links_base_file, 'a') as fw:
-                for link in all_links:
-                    link = re.sub(r'[^\x00-\x7f]', ' ', link)
-                    if not self.is_special_pattern_url(link):
-                        continue
-                    if link not in self.link_queue:
-                        if link not in self.crawled_links_list:
-                            self.link_queue.append(link)
-                            fw.write(link + '\n')
+            links = [link for link in CANONICALIZER.canonicalize_many(all_links, self.seed_url)
+                     if self.is_special_pattern_url(link)]
+            self.frontier.push_many(self.seen_links.add_many(links))
             return True
         except Exception as e:
             logging.error('Save all links：{}'.format(e))
@@ -164,18 +173,17 @@ class Spider(object):
     def run(self):
         # 多进程主循环
         while True:
+            url = None
             try:
-                if not self.link_queue:
+                # 入队时已经去过重，队列里的链接都没爬过
+                url = self.frontier.pop()
+                if url is None:
+                    # 其他进程可能还会产生新链接，等一会儿，仍然没有就从种子URL重新开始
                     time.sleep(20 + random.randint(1, 20))
-                    if not self.link_queue:
-                        self.load_links()
-                url = self.link_queue.pop(0)
+                    url = self.frontier.pop() or self.seed_url
                 self.save_crawled_links(url)
-                if url in self.crawled_links_list and url != self.seed_url:
-                    continue
 
                 html = get_html(url)
-                self.crawled_links_list.append(url)
                 if not html:
                     continue
 
@@ -189,17 +197,74 @@ class Spider(object):
             except Exception as e:
                 logging.critical('尚未预料的错误: {}'.format(e))
                 continue
+            finally:
+                # 处理完才从队列里删除，中途崩溃的链接会被收回重新爬
+                if url is not None:
+                    self.frontier.done(url)
+
+    async def crawl_async(self, engine):
+        # 异步模式下处理一个链接，解析在 engine 的进程池里执行
+        # 队列的 SQLite 事务、去重集合和缓存写入要等进程锁，放到 engine 的线程池里，不卡住其他请求
+        url = await engine.call(self.frontier.pop)
+        if url is None:
+            await asyncio.sleep(20 + random.randint(1, 20))
+            url = await engine.call(self.frontier.pop) or self.seed_url
+        try:
+            await engine.call(self.save_crawled_links, url)
+
+            html = await engine.get_html(url)
+            if not html:
+                return
+
+            content, links = await engine.parse(parse_page, html)
+            check_save_content = await engine.call(self.write_content, content)
+            check_save_all_links = await engine.call(self.save_links, links)
+
+            if check_save_content and check_save_all_links:
+                logging.warning('ok: {}'.format(url))
+        finally:
+            await engine.call(self.frontier.done, url)
+
+    def run_worker(self, target):
+        # 子进程入口：正常结束、Ctrl-C 或 SIGTERM 退出时都写入本进程缓存的内容
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            target()
+        finally:
+            self.flush_buffers()
+
+    def flush_buffers(self):
+        # 缓存的入队链接和已爬链接写入文件，还没处理完的链接放回队列，布隆过滤器写回文件
+        # 布隆过滤器里已经有这些链接，丢了入队缓存就再也不会入队
+        for flush in (self.frontier.close, self.crawled_links_writer.flush, self.seen_links.flush):
+            try:
+                flush()
+            except Exception as e:
+                logging.error('Flush buffers: {}'.format(e))
+
+    def run_async(self):
+        # 异步模式的进程函数
+        engine = AsyncEngine(args.async_concurrency, parse_workers=max(1, os.cpu_count() // self.process_num))
+        engine.run(self.crawl_async)
 
     def start(self):
-        # 载入链接到内存并启动多进程
-        self.load_links()
-        time.sleep(3)
+        # 启动多进程，待爬队列在文件里，不用等去重集合恢复完就可以开始爬
+        if self.frontier.empty() and not os.path.exists(self.links_base_file):
+            self.frontier.push(self.seed_url)
+            self.frontier.flush()
+        if args.rate:
+            set_rate_limiter(HostRateLimiter(args.rate, args.burst))
         processes = []
+        target = self.run_async if args.async_concurrency else self.run
         for i in range(self.process_num):
-            t = multiprocessing.Process(target=self.run, args=())
+            t = multiprocessing.Process(target=self.run_worker, args=(target,))
             t.start()
             processes.append(t)
 
+        # 子进程启动之后再开线程，避免 fork 时带着正在运行的线程
+        # 恢复完成之前，以前爬过的链接可能被再次入队
+        threading.Thread(target=self.load_links, daemon=True).start()
+
         for t in processes:
             t.join()
 
@@ -209,6 +274,15 @@ if __name__ == '__main__':
     parser.add_argument('output', help='输出文件夹路径，末尾不要带斜杠')
     parser.add_argument('-n', help='多进程数量（默认为1）', type=int, default=1)
     parser.add_argument('-p', help='网页前缀（默认为主页）', type=str, default='www')
+    parser.add_argument('--async-concurrency', help='异步模式，每个进程同时在飞的请求数（默认不启用）',
+                        type=int, default=0)
+    parser.add_argument('--seen_capacity', help='链接去重表容量（默认为400万）', type=int, default=4000000)
+    parser.add_argument('--dedup', help='去重方式: hash 精确，约 11 字节/条；bloom 布隆过滤器，约 2 字节/条，'
+                                        '保存在输出目录，重启后接着用（默认为hash）',
+                        choices=['hash', 'bloom'], default='hash')
+    parser.add_argument('--bloom_error_rate', help='布隆过滤器的误判率（默认为0.001）', type=float, default=0.001)
+    parser.add_argument('--rate', help='每个网站每秒最多请求数，所有进程共享（默认不限速）', type=float, default=0)
+    parser.add_argument('--burst', help='限速时允许的瞬时突发请求数（默认等于 rate）', type=float, default=0)
     parser.add_argument('--log', help='输出log到文件，否则输出到控制台', action='store_true')
     args = parser.parse_args()
 
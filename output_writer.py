@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-02-05
+#
+# 单独一个写入进程负责所有爬虫进程共享的大文件（未去重大文件、去重大文件、抓取失败的分页）
+#
+# 爬虫进程只把要追加的内容放进队列，自己不打开这些文件
+#   append(path, text)                    追加一段文本，一般是一个帖子
+#   append_file(path, source, remove)     追加一个文件的内容（长帖的临时文件或小文件），大段内容不经过队列
+# 写入进程一直开着这些文件，攒够 buffer_size 字节或每隔 flush_interval 秒整批写一次，
+# 每隔 fsync_interval 秒 fsync 一次（为 0 时不主动 fsync，由系统决定什么时候落盘），
+# 每隔 report_interval 秒输出一次写入速度
+# 每条记录都是整段追加，帖子之间不会交错；队列有上限，写入跟不上时爬虫进程等待
+#
+# 写入进程忽略 Ctrl-C（SIGINT），等主进程在爬虫进程都退出后 stop，把队列里剩下的记录写完再退出
+# 收到 SIGTERM 时写完队列里现有的记录就退出
+# 已经 commit 的帖子，ID 的完成进度已经越过了它，丢了就不会再爬，所以退出前一定要写完
+# 写入进程意外退出（比如写磁盘出错）后，爬虫进程再放记录时抛出 SystemExit 停止爬取，不会在队列上一直等下去
+#
+# 用法：在 fork 爬虫进程之前 start，所有爬虫进程结束后 stop（Ctrl-C 时也要 stop）
+# writer = OutputWriter(fsync_interval=10)
+# writer.start()
+# ...
+# writer.stop()
+
+import os
+import time
+import queue
+import shutil
+import signal
+import logging
+import multiprocessing
+import multiprocessing.connection
+
+# 队列结束标记
+_STOP = None
+
+
+class OutputWriter(object):
+
+    def __init__(self, buffer_size=4 * 1024 * 1024, flush_interval=1.0, fsync_interval=0, report_interval=60,
+                 queue_size=256):
+        """
+        在主进程创建，fork 出的爬虫进程共用同一个队列
+        :param buffer_size: 攒够多少字节写一次
+        :param flush_interval: 最多隔多少秒写一次
+        :param fsync_interval: 隔多少秒 fsync 一次，为 0 时不主动 fsync
+        :param report_interval: 隔多少秒输出一次写入速度
+        :param queue_size: 队列里最多多少条记录
+        """
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.report_interval = report_interval
+        self.queue = multiprocessing.Queue(queue_size)
+        self.process = None
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self._run, name='OutputWriter')
+        self.process.start()
+
+    def stop(self):
+        # 所有爬虫进程结束后调用，写完队列里剩下的内容再退出
+        try:
+            self._put(_STOP)
+        except SystemExit as e:
+            logging.critical(e)
+        self.process.join()
+
+    def append(self, path, text):
+        """
+        :param path: 大文件
+        :param text: 追加的文本
+        """
+        self._put((path, text.encode('utf-8'), None, False))
+
+    def append_file(self, path, source_path, remove=False):
+        """
+        :param path: 大文件
+        :param source_path: 把这个文件的内容追加到大文件
+        :param remove: 追加完删除 source_path
+        """
+        self._put((path, None, source_path, remove))
+
+    def _exited(self):
+        # 写入进程退出后 sentinel 变为可读；is_alive 只能在主进程里用，sentinel 在 fork 出的爬虫进程里也能用
+        return bool(multiprocessing.connection.wait([self.process.sentinel], 0))
+
+    def _put(self, record):
+        # 队列满时等待，每隔一秒检查一次写入进程是否还在
+        # 写入进程已经退出就没人取队列了：抛出 SystemExit 让爬虫进程停下，
+        # 而不是 Exception，否则会被当作一个帖子的普通错误，ID 的完成进度照样越过这个没写出去的帖子
+        while True:
+            if self._exited():
+                raise SystemExit('写入进程已经退出，停止爬取')
+            try:
+                self.queue.put(record, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _on_sigterm(self, signum, frame):
+        self._terminated = True
+
+    def _run(self):
+        # 写入进程
+        # Ctrl-C 会发给整个进程组，写入进程不能跟着退出
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self._terminated = False
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        # {path: 文件}
+        self._files = {}
+        # {path: [待写入的内容]}
+        self._pending = {}
+        self._pending_size = 0
+        # 写过还没 fsync 的文件
+        self._dirty = set()
+        self.records = 0
+        self.bytes = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        start_time = last_flush = last_fsync = last_report = time.time()
+        report_bytes = 0
+        while not self._terminated:
+            try:
+                # 最多等 1 秒，收到 SIGTERM 后很快就能退出
+                record = self.queue.get(timeout=min(self.flush_interval, 1.0))
+            except queue.Empty:
+                record = ()
+            if record is _STOP:
+                break
+            if record:
+                self._handle(*record)
+
+            now = time.time()
+            if self._pending_size >= self.buffer_size or now - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = now
+            if self.fsync_interval and now - last_fsync >= self.fsync_interval:
+                self._fsync()
+                last_fsync = now
+            if now - last_report >= self.report_interval:
+                self._report(self.bytes - report_bytes, now - last_report)
+                last_report = now
+                report_bytes = self.bytes
+
+        if self._terminated:
+            self._drain()
+        self._flush()
+        if self.fsync_interval:
+            self._fsync()
+        for f in self._files.values():
+            f.close()
+        self._report(self.bytes, time.time() - start_time)
+
+    def _drain(self):
+        # 处理队列里现有的记录，不再等新的
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if record is _STOP:
+                return
+            self._handle(*record)
+
+    def _file(self, path):
+        f = self._files.get(path)
+        if f is None:
+            f = self._files[path] = open(path, 'ab')
+        return f
+
+    def _handle(self, path, data, source_path, remove):
+        try:
+            if data is not None:
+                self._pending.setdefault(path, []).append(data)
+                self._pending_size += len(data)
+            else:
+                # 先写掉这个文件前面攒着的内容，保持顺序
+                self._flush_path(path)
+                f = self._file(path)
+                with open(source_path, 'rb') as fr:
+                    shutil.copyfileobj(fr, f, self.buffer_size)
+                    f.flush()
+                    self.bytes += fr.tell()
+                self._dirty.add(path)
+                if remove:
+                    os.remove(source_path)
+            self.records += 1
+        except Exception as e:
+            logging.error('Output writer {0}: {1}'.format(path, e))
+
+    def _flush_path(self, path):
+        chunks = self._pending.pop(path, None)
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        self._pending_size -= len(data)
+        try:
+            f = self._file(path)
+            f.write(data)
+            f.flush()
+            self.bytes += len(data)
+            self.flushes += 1
+            self._dirty.add(path)
+        except Exception as e:
+            logging.error('Output writer {0}: {1}'.format(path, e))
+
+    def _flush(self):
+        for path in list(self._pending):
+            self._flush_path(path)
+
+    def _fsync(self):
+        for path in self._dirty:
+            try:
+                os.fsync(self._files[path].fileno())
+                self.fsyncs += 1
+            except Exception as e:
+                logging.error('Fsync {0}: {1}'.format(path, e))
+        self._dirty.clear()
+
+    def _report(self, size, seconds):
+        try:
+            backlog = self.queue.qsize()
+        except NotImplementedError:
+            backlog = '?'
+        logging.warning('写入 {0} 条记录 {1:.1f} MB，最近 {2:.0f} 秒 {3:.2f} MB/s，写 {4} 次，fsync {5} 次，队列积压 {6}'.format(
+            self.records, self.bytes / 1048576, seconds, size / 1048576 / max(seconds, 0.001), self.flushes,
+            self.fsyncs, backlog))
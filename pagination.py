@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-02-03
+#
+# 并发抓取一个帖子的第 2..N 页，按页码顺序逐页返回
+#
+# 同时在抓的页数不超过 concurrency（滑动窗口），已经抓到但还没轮到返回的页也不会超过这个数
+# 抓取失败（或解析出错）的页按顺序再试 page_retries 次，仍然失败返回 None，由调用方记录下来以后补爬
+# 重试策略判为永久失败的页（404 等，见 utils.RetryPolicy）不再试，直接返回 None
+# 连接池大小要在 fork 之前用 configure_session 设置好（不小于 concurrency），这里不再改
+#
+# 用法
+# fetcher = PageFetcher(concurrency=4)
+# for url, content in zip(urls, fetcher.iter_pages(urls, get_content)):
+#     ...
+# 异步模式: async for content in fetcher.iter_pages_async(engine, urls, get_content)
+
+import os
+import asyncio
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import fetch_html, QUIET_FETCH_STATUSES
+
+# 再试也不会成功的抓取结果：永久失败（404、非法URL等），以及流式下载时按规则放弃的
+FINAL_FETCH_STATUSES = ('permanent', 'aborted', 'skipped')
+
+
+def check_fetch_result(result):
+    """
+    :param result: FetchResult
+    :return: (网页源代码, 失败时是否值得再试)，失败时源代码为空字符串
+    """
+    if result.ok:
+        return result.html, True
+    if result.status not in QUIET_FETCH_STATUSES:
+        logging.error('Get html ({0}): {1}: {2}'.format(result.status, result.error, result.url))
+    return '', result.status not in FINAL_FETCH_STATUSES
+
+
+class PageFetcher(object):
+
+    def __init__(self, concurrency=4, page_retries=1):
+        """
+        在主进程创建，fork 出的子进程各自建线程池
+        :param concurrency: 每个帖子同时抓取的页数
+        :param page_retries: 失败的页再试几次
+        """
+        self.concurrency = max(1, concurrency)
+        self.page_retries = page_retries
+        self._pool = None
+        self._pid = None
+
+    def _executor(self):
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.concurrency)
+            self._pid = os.getpid()
+        return self._pool
+
+    @staticmethod
+    def _fetch(url, parse):
+        # 抓取并解析一页，返回 (正文, 失败时是否值得再试)，失败时正文为 None
+        html, retryable = check_fetch_result(fetch_html(url))
+        if not html:
+            return None, retryable
+        try:
+            return parse(html), True
+        except Exception as e:
+            logging.error('Parse page: {0} | {1}'.format(e, url))
+            return None, True
+
+    def _retry(self, url, parse, fetched):
+        content, retryable = fetched
+        for _ in range(self.page_retries):
+            if content is not None or not retryable:
+                break
+            content, retryable = self._fetch(url, parse)
+        return content
+
+    def iter_pages(self, urls, parse):
+        """
+        :param urls: 各页网址，按页码排列
+        :param parse: html -> 正文
+        :return: 生成器，按顺序逐页返回正文，失败的页为 None
+        """
+        if self.concurrency == 1:
+            for url in urls:
+                yield self._retry(url, parse, self._fetch(url, parse))
+            return
+        executor = self._executor()
+        pending = collections.deque()
+        for url in urls:
+            pending.append((url, executor.submit(self._fetch, url, parse)))
+            if len(pending) >= self.concurrency:
+                url, future = pending.popleft()
+                yield self._retry(url, parse, future.result())
+        while pending:
+            url, future = pending.popleft()
+            yield self._retry(url, parse, future.result())
+
+    @staticmethod
+    async def _fetch_async(engine, url, parse):
+        html, retryable = check_fetch_result(await engine.fetch_html(url))
+        if not html:
+            return None, retryable
+        try:
+            return await engine.parse(parse, html), True
+        except Exception as e:
+            logging.error('Parse page: {0} | {1}'.format(e, url))
+            return None, True
+
+    async def _retry_async(self, engine, url, parse, fetched):
+        content, retryable = fetched
+        for _ in range(self.page_retries):
+            if content is not None or not retryable:
+                break
+            content, retryable = await self._fetch_async(engine, url, parse)
+        return content
+
+    async def iter_pages_async(self, engine, urls, parse):
+        """
+        异步版本，在 engine 上抓取，解析在 engine 的进程池里执行
+        :param engine: AsyncEngine
+        :param urls: 各页网址，按页码排列
+        :param parse: html -> 正文，必须是模块级函数
+        :return: 异步生成器，按顺序逐页返回正文，失败的页为 None
+        """
+        pending = collections.deque()
+        try:
+            for url in urls:
+                pending.append((url, asyncio.ensure_future(self._fetch_async(engine, url, parse))))
+                if len(pending) >= self.concurrency:
+                    url, task = pending.popleft()
+                    yield await self._retry_async(engine, url, parse, await task)
+            while pending:
+                url, task = pending.popleft()
+                yield await self._retry_async(engine, url, parse, await task)
+        finally:
+            # 提前退出时不要留下没人等的任务
+            for _, task in pending:
+                task.cancel()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-25
+#
+# 抓取、解析、写入分段执行的帖子流水线
+#
+#   取ID线程 --> 抓取队列 --> 抓取线程 x fetch_workers
+#                  ^               |
+#                  | 第2..N页      v  (有界队列，解析跟不上时抓取线程阻塞)
+#                  +---------- 汇总/写入线程 <-- 解析进程池 x parse_workers
+#
+# 网络等待在线程里，解析在进程池里，两者的并发数分别设置
+# 同时在处理的帖子数、等待解析的网页数都有上限，内存不会无限增长
+# 每个帖子同时在抓的页数也有上限，几百页的长帖不会占满所有抓取线程
+# 抓取失败的页重新放回抓取队列，重试后仍然失败的交给 failed_page 记录；404 等永久失败的页不再试
+# 抓取线程共用一个 Session，连接池大小要在 fork 之前用 configure_session 设置好（不小于 fetch_workers）
+# 各页正文按页码顺序逐页写进 open_post 返回的输出（见 post_output.py），先到的后面的页暂存在内存里
+
+import os
+import queue
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import fetch_html
+from pagination import check_fetch_result
+
+# 队列结束标记
+_STOP = None
+
+
+class PostPipeline(object):
+
+    def __init__(self, fetch_workers=8, parse_workers=None, max_pending_posts=None, page_concurrency=None,
+                 page_retries=1):
+        """
+        :param fetch_workers: 抓取线程数
+        :param parse_workers: 解析进程数，默认为 CPU 核数
+        :param max_pending_posts: 同时在处理的帖子数上限，默认为抓取线程数的两倍
+        :param page_concurrency: 每个帖子同时在抓的页数上限，默认不超过抓取线程数
+        :param page_retries: 失败的页再试几次
+        """
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.max_pending_posts = max_pending_posts or fetch_workers * 2
+        self.page_concurrency = page_concurrency or fetch_workers
+        self.page_retries = page_retries
+
+    def run(self, next_post_id, first_page_url, other_page_url, parse_first_page, parse_other_page,
+            check_first_page, open_post, commit_post, finish_post_id=None, failed_page=None):
+        """
+        运行流水线，直到 next_post_id 返回 None
+        :param next_post_id: 返回下一个帖子 ID
+        :param first_page_url: post_id -> 第一页网址
+        :param other_page_url: (post_id, 页码) -> 第N页网址
+        :param parse_first_page: html -> (标题, 正文, 页数)，必须是模块级函数
+        :param parse_other_page: html -> 正文，必须是模块级函数
+        :param check_first_page: (网址, 标题, 正文) -> 是否继续抓这个帖子
+        :param open_post: (post_id, 标题) -> 帖子的输出，有 write_page(正文) 和 abort() 方法
+        :param commit_post: (post_id, 标题, 输出, 页数) 各页都写完后调用
+        :param finish_post_id: post_id 处理完（无论是否保存）后调用
+        :param failed_page: (post_id, 网址) 重试后仍然失败的页
+        """
+        self.next_post_id = next_post_id
+        self.first_page_url = first_page_url
+        self.other_page_url = other_page_url
+        self.parse_first_page = parse_first_page
+        self.parse_other_page = parse_other_page
+        self.check_first_page = check_first_page
+        self.open_post = open_post
+        self.commit_post = commit_post
+        self.finish_post_id = finish_post_id
+        self.failed_page = failed_page
+
+        self.fetch_queue = queue.Queue()
+        self.parsed_queue = queue.Queue(maxsize=self.parse_workers * 2)
+        self.pending_posts = threading.BoundedSemaphore(self.max_pending_posts)
+        self.posts = {}
+
+        with ProcessPoolExecutor(self.parse_workers) as parse_pool:
+            self.parse_pool = parse_pool
+            threads = [threading.Thread(target=self._feed, daemon=True)]
+            threads += [threading.Thread(target=self._fetch, daemon=True) for _ in range(self.fetch_workers)]
+            for t in threads:
+                t.start()
+            self._collect()
+            for t in threads:
+                t.join()
+
+    def _feed(self):
+        # 取新帖子 ID 放进抓取队列，同时处理的帖子数满了就等待
+        while True:
+            self.pending_posts.acquire()
+            try:
+                post_id = self.next_post_id()
+            except Exception as e:
+                logging.critical('取ID问题: {}'.format(e))
+                self.pending_posts.release()
+                continue
+            if post_id is None:
+                break
+            self.fetch_queue.put((post_id, 1, self.first_page_url(post_id)))
+
+        # 等所有帖子处理完再通知其他线程退出
+        for _ in range(self.max_pending_posts - 1):
+            self.pending_posts.acquire()
+        for _ in range(self.fetch_workers):
+            self.fetch_queue.put(_STOP)
+        self.parsed_queue.put(_STOP)
+
+    def _fetch(self):
+        while True:
+            job = self.fetch_queue.get()
+            if job is _STOP:
+                break
+            post_id, page, url = job
+            html, retryable = check_fetch_result(fetch_html(url))
+            if not html:
+                self.parsed_queue.put((post_id, page, url, None, retryable))
+                continue
+            parse = self.parse_first_page if page == 1 else self.parse_other_page
+            self.parsed_queue.put((post_id, page, url, self.parse_pool.submit(parse, html), True))
+
+    def _result(self, future):
+        try:
+            return future.result()
+        except Exception as e:
+            logging.error('Parse: {}'.format(e))
+            return None
+
+    def _collect(self):
+        # 汇总每个帖子的各页正文，按页码顺序逐页写入，全部到齐后提交
+        while True:
+            item = self.parsed_queue.get()
+            if item is _STOP:
+                break
+            post_id, page, url, future, retryable = item
+            result = self._result(future) if future is not None else None
+            try:
+                if page == 1:
+                    self._collect_first_page(post_id, url, result)
+                else:
+                    self._collect_other_page(post_id, page, url, result, retryable)
+            except Exception as e:
+                logging.critical('尚未预料到的错误: {0} | {1}'.format(e, url))
+                self._finish(post_id)
+
+    def _collect_first_page(self, post_id, url, result):
+        if not result:
+            self._finish(post_id)
+            return
+        title, content, page_num = result
+        if not self.check_first_page(url, title, content):
+            self._finish(post_id)
+            return
+        output = self.open_post(post_id, title)
+        # written: 已经写入的页数; pages: {页码: 正文} 前面还有页没到齐的
+        # next_page: 下一个要放进抓取队列的页码; retries: {页码: 已重试次数}
+        state = {'title': title, 'page_num': page_num, 'output': output, 'written': 0, 'pages': {1: content},
+                 'next_page': 2, 'retries': {}}
+        self.posts[post_id] = state
+        self._write_pages(state)
+        if page_num <= 1:
+            self._save(post_id)
+            return
+        self._queue_pages(post_id, state)
+
+    def _queue_pages(self, post_id, state):
+        # 把后面的页放进抓取队列，这个帖子同时在抓的页数不超过 page_concurrency
+        in_flight = state['next_page'] - 1 - state['written'] - len(state['pages'])
+        while state['next_page'] <= state['page_num'] and in_flight < self.page_concurrency:
+            page = state['next_page']
+            self.fetch_queue.put((post_id, page, self.other_page_url(post_id, page)))
+            state['next_page'] += 1
+            in_flight += 1
+
+    def _collect_other_page(self, post_id, page, url, content, retryable=True):
+        state = self.posts.get(post_id)
+        if state is None:
+            return
+        if content is None:
+            retries = state['retries'].get(page, 0)
+            if retryable and retries < self.page_retries:
+                state['retries'][page] = retries + 1
+                self.fetch_queue.put((post_id, page, url))
+                return
+            if self.failed_page is not None:
+                self.failed_page(post_id, url)
+        state['pages'][page] = content or ''
+        self._write_pages(state)
+        if state['written'] == state['page_num']:
+            self._save(post_id)
+        else:
+            self._queue_pages(post_id, state)
+
+    def _write_pages(self, state):
+        # 从下一个要写的页开始，把已经到了的连续几页写进输出
+        while state['written'] + 1 in state['pages']:
+            state['written'] += 1
+            state['output'].write_page(state['pages'].pop(state['written']))
+
+    def _save(self, post_id):
+        state = self.posts[post_id]
+        self.commit_post(post_id, state['title'], state['output'], state['page_num'])
+        self._finish(post_id)
+
+    def _finish(self, post_id):
+        state = self.posts.pop(post_id, None)
+        if state is not None:
+            # 出错没有写完的帖子丢掉临时文件
+            try:
+                state['output'].abort()
+            except Exception as e:
+                logging.error('Abort post output: {}'.format(e))
+        if self.finish_post_id is not None:
+            try:
+                self.finish_post_id(post_id)
+            except Exception as e:
+                logging.error('Finish post id: {}'.format(e))
+        self.pending_posts.release()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-02-04
+#
+# 逐页保存一个帖子的正文，帖子写完时一次性生效
+#
+# 每抓到一页就写出去，内存里不保留整个长帖（几千页也一样）
+#   小文件       写进 小文件名.part，commit 时改名
+#   大文件       不超过 spill_size 时攒在内存里，超过后写进同目录下的 .post_*.part；有小文件时直接用小文件
+#   去重大文件   同上，按行去重，只记每行的哈希
+# commit 时整个帖子交给 writer 追加到大文件末尾（见 output_writer.py），
+# 没有 writer 时自己加文件锁追加；读文件的人看不到写了一半的帖子，多个进程的帖子也不会交错
+# 中途出错时 abort 删掉临时文件；进程被杀留下的 .part 文件可以直接删除
+#
+# 用法
+# with PostOutput(small_file, all_file, dedu_file, writer=writer) as output:
+#     for content in pages:
+#         output.write_page(content)
+#     output.commit()
+
+import os
+import fcntl
+import shutil
+import logging
+import tempfile
+
+
+def _temp_file(path):
+    # 和 path 在同一个目录，提交时不用跨文件系统复制
+    return tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(os.path.abspath(path)),
+                                       prefix='.post_', suffix='.part', delete=False)
+
+
+class _LockedAppender(object):
+    """
+    没有 writer 时使用：加文件锁，把一个帖子整段追加到大文件末尾
+    """
+
+    @staticmethod
+    def append(path, text):
+        with open(path, 'ab') as fw:
+            fcntl.flock(fw, fcntl.LOCK_EX)
+            try:
+                fw.write(text.encode('utf-8'))
+                fw.flush()
+            finally:
+                fcntl.flock(fw, fcntl.LOCK_UN)
+
+    @staticmethod
+    def append_file(path, source_path, remove=False):
+        with open(path, 'ab') as fw, open(source_path, 'rb') as fr:
+            fcntl.flock(fw, fcntl.LOCK_EX)
+            try:
+                shutil.copyfileobj(fr, fw, 1024 * 1024)
+                fw.flush()
+            finally:
+                fcntl.flock(fw, fcntl.LOCK_UN)
+        if remove:
+            os.remove(source_path)
+
+
+class _Spool(object):
+    """
+    要追加到某个大文件的内容：先攒在内存里，超过 spill_size 个字符后写进临时文件
+    """
+
+    def __init__(self, path, spill_size):
+        self.path = path
+        self.spill_size = spill_size
+        self.chunks = []
+        self.size = 0
+        self.file = None
+
+    def write(self, text):
+        if self.file is not None:
+            self.file.write(text)
+            return
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size > self.spill_size:
+            self.file = _temp_file(self.path)
+            self.file.write(''.join(self.chunks))
+            self.chunks = []
+
+    def commit(self, writer):
+        if self.file is None:
+            writer.append(self.path, ''.join(self.chunks))
+        else:
+            self.file.close()
+            # 临时文件交给 writer，追加完由它删除
+            writer.append_file(self.path, self.file.name, remove=True)
+            self.file = None
+        self.chunks = []
+
+    def abort(self):
+        self.chunks = []
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.file.name)
+            except OSError as e:
+                logging.error('Remove {0}: {1}'.format(self.file.name, e))
+
+
+class PostOutput(object):
+
+    def __init__(self, small_file=None, all_file=None, dedu_file=None, separator='', writer=None,
+                 spill_size=1024 * 1024):
+        """
+        :param small_file: 这个帖子的小文件，为 None 时不保存
+        :param all_file: 所有帖子追加到一起的大文件，为 None 时不保存
+        :param dedu_file: 按行去重后追加到一起的大文件，为 None 时不保存
+        :param separator: 各页正文之间的分隔符
+        :param writer: OutputWriter，为 None 时自己加文件锁追加
+        :param spill_size: 要追加到大文件的内容超过多少个字符后改写临时文件
+        """
+        self.small_file = small_file
+        self.all_file = all_file
+        self.dedu_file = dedu_file
+        self.separator = separator
+        self.writer = writer or _LockedAppender
+        # 已经写入的页数
+        self.pages = 0
+        self._part = None
+        # 有小文件时大文件直接从小文件追加
+        self._all = _Spool(all_file, spill_size) if all_file and not small_file else None
+        self._dedu = _Spool(dedu_file, spill_size) if dedu_file else None
+        # 去重时还没遇到换行的半行
+        self._tail = ''
+        self._seen = set()
+        self._done = False
+        if small_file:
+            self._part = open(small_file + '.part', 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 没有 commit 就退出（出错或者提前返回）时丢掉写了一半的内容
+        self.abort()
+        return False
+
+    def write_page(self, content):
+        """
+        写入下一页的正文
+        :param content: 正文
+        """
+        if self.pages and self.separator:
+            content = self.separator + content
+        self.pages += 1
+        if self._part is not None:
+            self._part.write(content)
+        if self._all is not None:
+            self._all.write(content)
+        if self._dedu is not None:
+            lines = (self._tail + content).split('\n')
+            self._tail = lines.pop()
+            for line in lines:
+                self._write_dedu_line(line)
+
+    def _write_dedu_line(self, line):
+        line = line.strip()
+        key = hash(line)
+        if key not in self._seen:
+            self._dedu.write(line + '\n')
+            self._seen.add(key)
+
+    def commit(self):
+        # 全部页都写完了：小文件改名，大文件交给 writer 追加
+        if self._done:
+            return
+        if self._part is not None:
+            self._part.close()
+            os.replace(self._part.name, self.small_file)
+        self._done = True
+        try:
+            if self.all_file:
+                if self.small_file:
+                    self.writer.append_file(self.all_file, self.small_file)
+                else:
+                    self._all.commit(self.writer)
+            if self._dedu is not None:
+                self._write_dedu_line(self._tail)
+                self._dedu.commit(self.writer)
+        except Exception:
+            for spool in (self._all, self._dedu):
+                if spool is not None:
+                    spool.abort()
+            raise
+
+    def abort(self):
+        # 删掉临时文件，已经 commit 过时什么也不做
+        if self._done:
+            return
+        self._done = True
+        if self._part is not None:
+            self._part.close()
+            try:
+                os.remove(self._part.name)
+            except OSError as e:
+                logging.error('Remove {0}: {1}'.format(self._part.name, e))
+        for spool in (self._all, self._dedu):
+            if spool is not None:
+                spool.abort()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-15
+#
+# 按健康度挑选代理的代理池
+# 记录每个代理的成功率和响应时间，优先使用又快又稳的代理
+# 连续失败的代理先隔离一段时间，多次隔离仍然失败则丢弃
+# 可用代理太少时从代理源重新获取
+#
+# 代理源是一个无参数的可调用对象，返回 ['http://ip:port', ...]
+# 在主进程创建并 refresh() 一次，再交给 utils.set_proxy_pool()，
+# fork 出的每个子进程各自维护自己的统计，请求时不需要进程间通信
+# 同一个进程里的抓取线程共用一个代理池，读写统计时加线程锁
+
+import time
+import random
+import logging
+import requests
+import threading
+
+
+class ApiProxySource(object):
+    # 通过第三方API获取代理地址
+    def __init__(self, url='http://lab.crossincode.com/proxy/get/?num=100', timeout=20):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self):
+        response = requests.get(self.url, timeout=self.timeout)
+        return [proxy['http'] for proxy in response.json()['proxies']]
+
+
+class FileProxySource(object):
+    # 从文本文件读取代理地址，每行一个
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        with open(self.path, 'r') as fr:
+            return [line.strip() for line in fr if line.strip()]
+
+
+class ProxyStats(object):
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.quarantine_times = 0
+        self.quarantined_until = 0
+        # 响应时间的指数加权平均
+        self.latency = None
+
+    @property
+    def success_rate(self):
+        # 拉普拉斯平滑，新代理按 50% 算
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def score(self, default_latency):
+        latency = self.latency if self.latency is not None else default_latency
+        return self.success_rate / max(latency, 0.05)
+
+
+class ProxyPool(object):
+
+    def __init__(self, source, min_healthy=10, max_consecutive_failures=3, quarantine_seconds=60,
+                 max_quarantine_times=3, min_refresh_interval=60, latency_alpha=0.3):
+        """
+        :param source: 代理源，调用后返回代理地址列表
+        :param min_healthy: 可用代理少于这个数就去代理源获取
+        :param max_consecutive_failures: 连续失败多少次后隔离
+        :param quarantine_seconds: 第一次隔离的秒数，之后每次翻倍
+        :param max_quarantine_times: 被隔离超过多少次后丢弃
+        :param min_refresh_interval: 两次获取代理之间至少间隔的秒数
+        :param latency_alpha: 响应时间加权平均的权重
+        """
+        self.source = source
+        self.min_healthy = min_healthy
+        self.max_consecutive_failures = max_consecutive_failures
+        self.quarantine_seconds = quarantine_seconds
+        self.max_quarantine_times = max_quarantine_times
+        self.min_refresh_interval = min_refresh_interval
+        self.latency_alpha = latency_alpha
+        self.proxies = {}
+        self.last_refresh = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """
+        从代理源获取代理，加入池中
+        :param force: 忽略最小刷新间隔
+        :return: 新加入的代理数
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self.last_refresh < self.min_refresh_interval:
+                return 0
+            self.last_refresh = now
+        # 获取代理时不持有锁，其他线程照常挑选代理
+        try:
+            new_proxies = self.source()
+        except Exception as e:
+            logging.error('Refresh proxies: {}'.format(e))
+            return 0
+        added = 0
+        with self._lock:
+            for proxy in new_proxies:
+                if proxy not in self.proxies:
+                    self.proxies[proxy] = ProxyStats()
+                    added += 1
+            total = len(self.proxies)
+        logging.warning('Refresh proxies: {0} new, {1} total'.format(added, total))
+        return added
+
+    def _healthy_stats(self, now=None):
+        # 当前没有被隔离的 (代理, 统计)，在锁内复制一份
+        now = now or time.time()
+        with self._lock:
+            return [(proxy, stats) for proxy, stats in self.proxies.items() if stats.quarantined_until <= now]
+
+    def healthy(self, now=None):
+        # 当前没有被隔离的代理
+        return [proxy for proxy, _ in self._healthy_stats(now)]
+
+    def choose(self):
+        """
+        按 成功率/响应时间 加权随机挑一个代理
+        :return: 代理地址，池为空返回 None
+        """
+        healthy = self._healthy_stats()
+        if len(healthy) < self.min_healthy:
+            self.refresh()
+            healthy = self._healthy_stats()
+        if not healthy:
+            return None
+        latencies = [stats.latency for _, stats in healthy if stats.latency is not None]
+        # 没测过的代理按平均响应时间算，让它们有机会被试用
+        default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+        weights = [stats.score(default_latency) for _, stats in healthy]
+        return random.choices([proxy for proxy, _ in healthy], weights=weights)[0]
+
+    def report(self, proxy, ok, latency=None):
+        """
+        记录一次请求的结果
+        :param proxy: 代理地址
+        :param ok: 是否成功
+        :param latency: 请求耗时（秒）
+        """
+        with self._lock:
+            stats = self.proxies.get(proxy)
+            if stats is None:
+                return
+            if ok:
+                stats.successes += 1
+                stats.consecutive_failures = 0
+                if latency is not None:
+                    if stats.latency is None:
+                        stats.latency = latency
+                    else:
+                        stats.latency = self.latency_alpha * latency + (1 - self.latency_alpha) * stats.latency
+                return
+
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= self.max_consecutive_failures:
+                stats.consecutive_failures = 0
+                stats.quarantine_times += 1
+                if stats.quarantine_times > self.max_quarantine_times:
+                    del self.proxies[proxy]
+                    return
+                stats.quarantined_until = time.time() + self.quarantine_seconds * 2 ** (stats.quarantine_times - 1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-12
+#
+# 按网站（host）限速的令牌桶，所有子进程共享同一块内存
+# 必须在主进程创建、fork 子进程之前交给 utils.set_rate_limiter()
+#
+# 共享内存布局：每个 host 占一个槽 [host 哈希, 剩余令牌数, 上次补充时间]
+# 开放寻址，槽用完之后新的 host 不再限速
+
+import time
+import zlib
+import multiprocessing
+from urllib.parse import urlsplit
+
+# 每个槽占用的 double 数量
+SLOT_SIZE = 3
+
+
+class HostRateLimiter(object):
+
+    def __init__(self, rate, burst=None, host_rates=None, slots=256):
+        """
+        :param rate: 每个 host 每秒允许的请求数
+        :param burst: 令牌桶容量，即允许的瞬时突发请求数，默认与 rate 相同（至少为1）
+        :param host_rates: 个别 host 的配置 {host: (rate, burst)}
+        :param slots: 最多同时限速多少个 host
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.host_rates = host_rates or {}
+        self.slots = slots
+        # lock=False: 读写都在下面这把锁里完成
+        self.table = multiprocessing.Array('d', slots * SLOT_SIZE, lock=False)
+        self.lock = multiprocessing.Lock()
+
+    def _config(self, host):
+        rate, burst = self.host_rates.get(host, (self.rate, self.burst))
+        return float(rate), float(burst)
+
+    def _find_slot(self, key):
+        # 找到 key 对应的槽，没有则占用一个空槽，满了返回 -1
+        start = int(key) % self.slots
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            slot_key = self.table[slot * SLOT_SIZE]
+            if slot_key == key:
+                return slot
+            if slot_key == 0:
+                self.table[slot * SLOT_SIZE] = key
+                self.table[slot * SLOT_SIZE + 1] = -1
+                return slot
+        return -1
+
+    def reserve(self, host):
+        """
+        预定一个令牌，不阻塞
+        :param host: 网站 host
+        :return: 需要等待多少秒后才能发出请求
+        """
+        rate, burst = self._config(host)
+        # 0 表示空槽，所以哈希值加 1
+        key = float(zlib.crc32(host.encode('utf-8')) + 1)
+        now = time.monotonic()
+        with self.lock:
+            slot = self._find_slot(key)
+            if slot < 0:
+                return 0
+            base = slot * SLOT_SIZE
+            tokens = self.table[base + 1]
+            last = self.table[base + 2]
+            if tokens < 0 and last == 0:
+                # 新的 host 从满桶开始
+                tokens = burst
+            else:
+                tokens = min(burst, tokens + (now - last) * rate)
+            tokens -= 1
+            self.table[base + 1] = tokens
+            self.table[base + 2] = now
+        if tokens >= 0:
+            return 0
+        return -tokens / rate
+
+    def acquire(self, host):
+        # 阻塞到可以发出请求为止
+        wait = self.reserve(host)
+        if wait > 0:
+            time.sleep(wait)
+
+    def acquire_url(self, url):
+        self.acquire(urlsplit(url).hostname or '')
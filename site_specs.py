@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-18
+#
+# 各网站的抽取规则，由 extractor.Extractor 编译执行
+# 新增网站或者网站改版时只需要改这里
+#
+# title       标题
+#   select    选择器列表，依次尝试，取第一个有文字的节点
+#   markers   找不到标题时，页面里出现这些提示语就把提示语当作标题返回
+# body        正文，每个 select 到的节点是一块（楼层、段落）
+#   select    选择器
+#   remove    先删掉块里的这些节点（如引用、脚本）
+#   br        <br> 替换成的文本，默认直接去掉
+#   sub       [(正则, 替换文本), ...]，依次作用在每块的文本上
+#   match     只保留每块文本里第一个匹配这个正则的部分
+#   require   页面里必须出现这段文字，否则正文为空
+#   prefix / suffix / join   每块前后加的文本、块之间的分隔符
+#   （每块文本都会去掉首尾空白，空块跳过）
+# pagination  页数
+#   select    分页链接的选择器
+#   attr      从哪个属性取值（默认 href）
+#   pattern   正则，第一个分组是页码
+#   pick      取第几个页码（默认 -1 即最后一个；-2 用于最后一个链接是"下一页"的情况）
+# links       需要继续爬的链接
+#   pattern   在网页源码上匹配的正则
+# canonical   链接规范化（url_canon.Canonicalizer），在去重和入队之前执行
+#   drop_query   去掉全部参数
+#   keep_params  只保留这些参数（默认只去掉 utm_* 等跟踪参数）
+#   rewrite      [(正则, 替换文本), ...]，依次作用在规范化后的链接上
+# fetch       流式下载（utils.StreamLimits），爬虫加 --stream 时生效
+#   abort        网页里出现这些文字就停止下载，当作无效页面（如被删帖子的提示语）
+#   max_bytes    最多下载多少字节
+#   html_only    不是 HTML 的内容不下载（默认 True）
+
+# 贴吧被删、被合并、被隐藏的帖子的提示语
+TIEBA_DROPPED_MARKERS = ['很抱歉，该贴已被删除。', '该吧被合并您所访问的贴子无法显示', '抱歉，您访问的贴子被隐藏，暂时无法访问。']
+
+SITE_SPECS = {
+    'tieba': {
+        'title': {
+            'select': ['h1', 'h3'],
+            'markers': TIEBA_DROPPED_MARKERS,
+        },
+        'body': {
+            'select': 'div.d_post_content_main div.d_post_content',
+            'match': r'\S.+',
+            'suffix': '\n\n',
+        },
+        'pagination': {
+            'select': 'ul.l_posts_num a',
+            'pattern': r'pn=([0-9]+)',
+        },
+        'fetch': {
+            'abort': TIEBA_DROPPED_MARKERS,
+            'max_bytes': 4 * 1024 * 1024,
+        },
+    },
+    'hupu': {
+        'title': {
+            'select': ['h1'],
+        },
+        'body': {
+            'select': 'div.quote-content',
+            'remove': ['blockquote', 'small'],
+            'sub': [(r'@.+?[\s]', '')],
+            'join': '\n\n',
+        },
+        'pagination': {
+            'select': 'div.page a',
+            'pattern': r'/[0-9]+-([0-9]+)\.html',
+            'pick': -2,
+        },
+        'fetch': {
+            'max_bytes': 4 * 1024 * 1024,
+        },
+    },
+    'tianya': {
+        'title': {
+            'select': ['span.s_title'],
+        },
+        'body': {
+            'select': 'div.atl-item div.bbs-content',
+            'br': '<br>',
+            'sub': [(r'@[\s\S]+?<br>|<br>|-', '')],
+            'suffix': '\n\n',
+        },
+        'pagination': {
+            'select': 'div.atl-pages a',
+            'pattern': r'-([0-9]+)\.shtml',
+            'pick': -2,
+        },
+        'fetch': {
+            'max_bytes': 4 * 1024 * 1024,
+        },
+    },
+    'baike': {
+        'body': {
+            'select': 'div.para',
+            'sub': [('\n', ''), (r'\[[0-9]+-*[0-9]*]', '')],
+            'prefix': '\n',
+        },
+        'links': {
+            'pattern': r'/item/[%A-Z0-9/]+',
+        },
+        'canonical': {
+            # 词条页的参数（fromtitle、fromModule 等）都不影响内容
+            'drop_query': True,
+            'rewrite': [(r'^http://', 'https://')],
+        },
+    },
+    '163': {
+        'body': {
+            'select': 'div.overview p, div.post_text p',
+            'remove': ['script', 'style'],
+        },
+        'links': {
+            'pattern': r'http://\S+?html',
+        },
+        'canonical': {
+            'drop_query': True,
+            # 种子链接和 is_special_pattern_url 都按 http 判断
+            'rewrite': [(r'^https://', 'http://')],
+        },
+    },
+    '17k': {
+        'title': {
+            'select': ['h1'],
+        },
+        'body': {
+            'select': 'div.p',
+            'require': '本书首发来自17K小说网，第一时间看正版内容！',
+            'sub': [(r'本书首发来自17K小说网，第一时间看正版内容！[\s\S]*', '')],
+        },
+    },
+}
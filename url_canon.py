@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-29
+#
+# 链接规范化，在去重和入队之前把同一个网页的不同写法变成同一个链接
+#   相对链接补全、scheme/host 小写、去掉默认端口
+#   百分号编码统一（不需要编码的字符解码，十六进制大写，非 ASCII 字符编码）
+#   去掉 #片段 和跟踪参数（utm_* 等），可按网站去掉全部参数
+#   最后按网站的 rewrite 规则改写，规则写在 site_specs.py 的 canonical 里
+#
+# 检查一份已爬链接里有多少重复
+# python3 url_canon.py temp_crawled_links.txt --site baike
+
+import re
+import argparse
+from urllib.parse import urljoin, urlsplit, urlunsplit, quote, parse_qsl, urlencode
+
+# 不影响网页内容的跟踪参数
+TRACKING_PARAMS = {'spm', 'from', 'fr', 'ref', 'refer', 'source', 'share', 'timestamp', '_t', 'fromtitle', 'fromid'}
+TRACKING_PREFIXES = ('utm_',)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# RFC 3986 中不需要编码的字符，编码了也应该还原
+UNRESERVED = set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+PERCENT_RE = re.compile(r'%([0-9A-Fa-f]{2})')
+PATH_SAFE = "/%:@!$&'()*+,;=-._~"
+QUERY_SAFE = "/%:@!$'()*+,;=-._~?"
+
+# 已经是规范形式的链接: 小写 host、没有端口、参数和片段，路径里只有不用编码的字符和非 ASCII 字节的编码
+# 页面上的链接大多如此，只需执行 rewrite，不用拆开再拼起来
+CLEAN_URL_RE = re.compile(r"https?://[a-z0-9-]+(?:\.[a-z0-9-]+)*/(?:[A-Za-z0-9\-_~!$&'()*+,;=:@/]|\.(?<!/\.)|%[89A-F][0-9A-F])*")
+
+
+def _normalize_escape(match):
+    char = chr(int(match.group(1), 16))
+    if char in UNRESERVED:
+        return char
+    return '%' + match.group(1).upper()
+
+
+def normalize_percent_encoding(text, safe=PATH_SAFE):
+    """
+    :param text: 路径或参数
+    :param safe: 不需要编码的字符
+    :return: 编码统一后的文本
+    """
+    return quote(PERCENT_RE.sub(_normalize_escape, text), safe=safe)
+
+
+class Canonicalizer(object):
+
+    def __init__(self, spec=None):
+        """
+        :param spec: site_specs.py 中的 canonical 规则
+            drop_query  去掉全部参数
+            keep_params 只保留这些参数
+            rewrite     [(正则, 替换文本), ...]，依次作用在规范化后的链接上
+        """
+        spec = spec or {}
+        self.drop_query = spec.get('drop_query', False)
+        self.keep_params = set(spec.get('keep_params', []))
+        self.rewrites = [(re.compile(p), r) for p, r in spec.get('rewrite', [])]
+
+    def _keep_param(self, name):
+        if self.keep_params:
+            return name in self.keep_params
+        return name.lower() not in TRACKING_PARAMS and not name.lower().startswith(TRACKING_PREFIXES)
+
+    def canonicalize(self, url, base=None):
+        """
+        :param url: 链接，可以是相对链接
+        :param base: 所在网页的链接，用于补全相对链接
+        :return: 规范化后的链接，无法解析时返回空字符串
+        """
+        url = url.strip()
+        if base:
+            url = urljoin(base, url)
+        if CLEAN_URL_RE.fullmatch(url):
+            return self._rewrite(url)
+        try:
+            parts = urlsplit(url)
+            port = parts.port
+        except ValueError:
+            return ''
+
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').rstrip('.')
+        netloc = host
+        if port and port != DEFAULT_PORTS.get(scheme):
+            netloc = '{0}:{1}'.format(host, port)
+
+        path = normalize_percent_encoding(parts.path) or '/'
+
+        query = ''
+        if parts.query and not self.drop_query:
+            params = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if self._keep_param(k)]
+            query = normalize_percent_encoding(urlencode(params), QUERY_SAFE)
+
+        return self._rewrite(urlunsplit((scheme, netloc, path, query, '')))
+
+    def _rewrite(self, url):
+        for pattern, repl in self.rewrites:
+            url = pattern.sub(repl, url)
+        return url
+
+    def canonicalize_many(self, urls, base=None):
+        """
+        :param urls: 链接列表
+        :param base: 所在网页的链接
+        :return: 规范化并去重后的链接，保持原顺序
+        """
+        origin = ''
+        if base:
+            parts = urlsplit(base)
+            origin = '{0}://{1}'.format(parts.scheme, parts.netloc)
+        canonical = []
+        # 同一页面上重复的链接只处理一次
+        for url in dict.fromkeys(urls):
+            if origin and url.startswith('/') and not url.startswith('//') and '/.' not in url:
+                # 以 / 开头的相对链接直接拼上 scheme 和 host，比 urljoin 快得多
+                canonical.append(self.canonicalize(origin + url))
+            else:
+                canonical.append(self.canonicalize(url, base))
+        return [url for url in dict.fromkeys(canonical) if url]
+
+
+def count_duplicates(path, canonicalizer):
+    # 统计链接文件里原样不同、规范化后相同的链接数
+    raw = set()
+    canonical = set()
+    with open(path, 'r', encoding='utf-8', errors='replace') as fr:
+        for line in fr:
+            line = line.strip()
+            if line:
+                raw.add(line)
+                canonical.add(canonicalizer.canonicalize(line))
+    return len(raw), len(canonical)
+
+
+if __name__ == '__main__':
+    from site_specs import SITE_SPECS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('links_file', help='链接文件，每行一个（如 temp_crawled_links.txt）')
+    parser.add_argument('--site', help='使用哪个网站的规则（默认只做通用规范化）', type=str, default='')
+    args = parser.parse_args()
+
+    site_spec = SITE_SPECS[args.site].get('canonical') if args.site else None
+    raw_count, canonical_count = count_duplicates(args.links_file, Canonicalizer(site_spec))
+    print('不同的链接 {0} 条，规范化后 {1} 条，可以少爬 {2} 次（{3:.1f}%）'.format(
+        raw_count, canonical_count, raw_count - canonical_count,
+        (raw_count - canonical_count) * 100 / max(raw_count, 1)))
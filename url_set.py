@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created by FFJ on 18-01-26
+#
+# 所有子进程共享的链接去重集合，判断和加入都是 O(1)
+# 代替 Manager().list() 上的 `link not in list`（每次都要经过进程间通信再线性扫描）
+#
+# SharedUrlSet  共享内存里的开放寻址哈希表，每个槽存链接的 64 位指纹（0 表示空槽）
+#               每个链接约占 8 / 0.75 ≈ 11 字节，不保存链接字符串本身，不会误判
+# BloomUrlSet   布隆过滤器，可以保存到文件（mmap），重启后直接接着用
+#               误判率 0.1% 时每个链接约 1.8 字节，误判的链接会被当成爬过而跳过
+#
+# 两者接口相同（add / add_many / in / len / flush），都必须在主进程创建、fork 子进程之前创建
+
+import os
+import math
+import mmap
+import struct
+import hashlib
+import logging
+import multiprocessing
+
+# 装载率超过这个值后探测长度变长，容量按它换算成槽数
+MAX_LOAD_FACTOR = 0.75
+
+
+def url_fingerprint(url):
+    """
+    :param url: 链接
+    :return: 64 位指纹，不为 0
+    """
+    digest = hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class SharedUrlSet(object):
+
+    def __init__(self, capacity=4000000):
+        """
+        :param capacity: 预计最多记录多少个链接，表的大小按它一次分配好，之后不能扩容
+        """
+        self.capacity = capacity
+        slots = 1
+        while slots * MAX_LOAD_FACTOR < capacity:
+            slots *= 2
+        self.slots = slots
+        self.mask = slots - 1
+        # lock=False: 读写都在下面这把锁里完成
+        self.table = multiprocessing.RawArray('Q', slots)
+        self.count = multiprocessing.RawValue('q', 0)
+        self.lock = multiprocessing.Lock()
+        # 只在内存里，不会从文件恢复
+        self.restored = False
+
+    def _probe(self, fingerprint, insert):
+        # 线性探测，返回是否新加入（insert=False 时返回是否存在）
+        table = self.table
+        index = fingerprint & self.mask
+        while True:
+            slot = table[index]
+            if slot == fingerprint:
+                return not insert
+            if slot == 0:
+                if not insert:
+                    return False
+                if self.count.value >= self.slots - 1:
+                    raise OverflowError('链接去重表已满（{} 条），请调大容量'.format(self.count.value))
+                table[index] = fingerprint
+                self.count.value += 1
+                if self.count.value == self.capacity:
+                    logging.warning('链接去重表已达到预计容量 {}，继续加入会变慢'.format(self.capacity))
+                return True
+            index = (index + 1) & self.mask
+
+    def add(self, url):
+        """
+        :param url: 链接
+        :return: 是否是新链接（之前不在集合里）
+        """
+        fingerprint = url_fingerprint(url)
+        with self.lock:
+            return self._probe(fingerprint, True)
+
+    def add_many(self, urls):
+        """
+        一次加锁加入一批链接
+        :param urls: 链接列表
+        :return: 其中的新链接，保持原顺序
+        """
+        fingerprints = [url_fingerprint(url) for url in urls]
+        with self.lock:
+            return [url for url, fingerprint in zip(urls, fingerprints) if self._probe(fingerprint, True)]
+
+    def __contains__(self, url):
+        fingerprint = url_fingerprint(url)
+        with self.lock:
+            return self._probe(fingerprint, False)
+
+    def __len__(self):
+        return self.count.value
+
+    def flush(self):
+        # 只在内存里，没有要写回的
+        pass
+
+
+# 布隆过滤器文件头: 魔数, 位数, 哈希函数个数, 已加入的链接数
+BLOOM_MAGIC = b'URLBLOOM'
+BLOOM_HEADER = struct.Struct('<8sQQQ')
+
+
+class BloomUrlSet(object):
+
+    def __init__(self, capacity=4000000, error_rate=0.001, path=None):
+        """
+        :param capacity: 预计最多记录多少个链接，超过后误判率会上升
+        :param error_rate: 达到容量时的误判率
+        :param path: 保存位图的文件，已存在则直接载入；为 None 时只在内存里
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        size = BLOOM_HEADER.size + (self.bits + 7) // 8
+        self.path = path
+        # 从文件载入时为 True，说明里面已经有上次运行的链接
+        self.restored = False
+
+        if path is None:
+            self.mm = mmap.mmap(-1, size)
+            BLOOM_HEADER.pack_into(self.mm, 0, BLOOM_MAGIC, self.bits, self.hashes, 0)
+        else:
+            exists = os.path.exists(path) and os.path.getsize(path) > 0
+            with open(path, 'r+b' if exists else 'w+b') as f:
+                if not exists:
+                    f.truncate(size)
+                self.mm = mmap.mmap(f.fileno(), 0)
+            magic, bits, hashes, _ = BLOOM_HEADER.unpack_from(self.mm, 0)
+            if not exists:
+                BLOOM_HEADER.pack_into(self.mm, 0, BLOOM_MAGIC, self.bits, self.hashes, 0)
+            elif magic != BLOOM_MAGIC or bits != self.bits or hashes != self.hashes:
+                raise ValueError('{} 不是用相同容量和误判率创建的布隆过滤器'.format(path))
+            else:
+                self.restored = True
+                logging.warning('载入布隆过滤器 {0}，已有 {1} 条链接'.format(path, len(self)))
+        self.lock = multiprocessing.Lock()
+
+    def _positions(self, url):
+        # 双重哈希: 第 i 个位置为 h1 + i * h2
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _set(self, positions):
+        # 置位，返回是否至少有一位原来是 0（即新链接）
+        mm = self.mm
+        new = False
+        for position in positions:
+            index = BLOOM_HEADER.size + (position >> 3)
+            mask = 1 << (position & 7)
+            byte = mm[index]
+            if not byte & mask:
+                mm[index] = byte | mask
+                new = True
+        if new:
+            count = len(self) + 1
+            struct.pack_into('<Q', mm, 24, count)
+            if count == self.capacity:
+                logging.warning('布隆过滤器已达到预计容量 {}，误判率开始上升'.format(self.capacity))
+        return new
+
+    def add(self, url):
+        """
+        :param url: 链接
+        :return: 是否是新链接（之前不在集合里）
+        """
+        positions = self._positions(url)
+        with self.lock:
+            return self._set(positions)
+
+    def add_many(self, urls):
+        """
+        一次加锁加入一批链接
+        :param urls: 链接列表
+        :return: 其中的新链接，保持原顺序
+        """
+        all_positions = [self._positions(url) for url in urls]
+        with self.lock:
+            return [url for url, positions in zip(urls, all_positions) if self._set(positions)]
+
+    def __contains__(self, url):
+        mm = self.mm
+        for position in self._positions(url):
+            if not mm[BLOOM_HEADER.size + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return struct.unpack_from('<Q', self.mm, 24)[0]
+
+    def flush(self):
+        # 把位图写回文件
+        if self.path is not None:
+            self.mm.flush()
@@ -2,13 +2,18 @@
 # -*- coding: utf-8 -*-
 # Created by FFJ on 17-12-25
 
+import os
 import re
+import codecs
 import json
 import time
 import random
 import logging
+import threading
 import requests
 import multiprocessing
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 
 # User Agent 列表，每次访问随机使用其中一个
 USER_AGENT_LIST = [
@@ -120,34 +125,496 @@ USER_AGENT_LIST = [
     'ter PC 5.0; InfoPath.2; .NET CLR 3.5.30729; .NET CLR 3.0.30618; .NET CLR 1.1.4322)',
 ]
 
-# 代理列表
-PROXIES_LIST = multiprocessing.Manager().list()
+# 连接池配置
+# 最多缓存多少个 host 的连接池
+POOL_CONNECTIONS = 10
+# 每个 host 最多保持多少条 keep-alive 连接
+POOL_MAXSIZE = 10
+# host 空闲超过多少秒后回收它的连接
+POOL_IDLE_TIMEOUT = 60
 
+# 每个进程独立的 Session，fork 出的子进程不能复用父进程的 socket
+_session = None
+_session_pid = None
+# host -> 最近一次使用的时间
+_host_last_used = {}
+_last_evict_time = 0
 
-def get_html(url, use_proxy=False):
+
+def configure_session(pool_connections=None, pool_maxsize=None, idle_timeout=None):
     """
-    获取URL的源代码
-    :param url: 网址
-    :param use_proxy: 是否使用代理
+    修改连接池配置，已经创建的 Session 会在下次请求时按新配置重建
+    :param pool_connections: 最多缓存多少个 host 的连接池
+    :param pool_maxsize: 每个 host 最多保持的连接数
+    :param idle_timeout: host 空闲超过多少秒后回收连接
+    """
+    global POOL_CONNECTIONS, POOL_MAXSIZE, POOL_IDLE_TIMEOUT, _session
+    if pool_connections is not None:
+        POOL_CONNECTIONS = pool_connections
+    if pool_maxsize is not None:
+        POOL_MAXSIZE = pool_maxsize
+    if idle_timeout is not None:
+        POOL_IDLE_TIMEOUT = idle_timeout
+    if _session is not None and _session_pid == os.getpid():
+        _session.close()
+    _session = None
+
+
+def get_session():
+    """
+    获取当前进程的 keep-alive Session，不存在或者是从父进程继承来的则重新创建
+    :return: requests.Session
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+        _session_pid = os.getpid()
+        _host_last_used.clear()
+    return _session
+
+
+def evict_idle_connections(now=None):
+    """
+    关闭空闲超过 POOL_IDLE_TIMEOUT 秒的 host 连接池
+    :param now: 当前时间，默认 time.time()
+    :return: 回收的连接池数量
+    """
+    if _session is None or _session_pid != os.getpid():
+        return 0
+    if now is None:
+        now = time.time()
+    evicted = 0
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            last_used = _host_last_used.get(key.key_host, 0)
+            if now - last_used > POOL_IDLE_TIMEOUT:
+                try:
+                    del pools[key]
+                    evicted += 1
+                except KeyError:
+                    pass
+    for host, last_used in list(_host_last_used.items()):
+        if now - last_used > POOL_IDLE_TIMEOUT:
+            del _host_last_used[host]
+    return evicted
+
+
+def _mark_host_used(url):
+    # 记录 host 的使用时间，并且最多每半个空闲周期检查一次空闲连接
+    global _last_evict_time
+    now = time.time()
+    _host_last_used[urlsplit(url).hostname] = now
+    if now - _last_evict_time > POOL_IDLE_TIMEOUT / 2:
+        _last_evict_time = now
+        evict_idle_connections(now)
+
+
+# 页面编码缓存：(host, 路径第一段) -> 编码，同一类页面的编码一般不会变
+_encoding_cache = {}
+
+# 只在前几 KB 里找 <meta charset>
+META_SNIFF_BYTES = 4096
+# 统计检测只看前 64 KB
+DETECT_SAMPLE_BYTES = 65536
+
+HEADER_CHARSET_RE = re.compile(r'charset=["\']?([-\w]+)', re.I)
+META_CHARSET_RE = re.compile(rb'<meta[^>]+?charset=["\']?([-\w]+)', re.I)
+
+# gb2312 页面里经常混着 gbk 字符，统一按超集解码
+ENCODING_ALIASES = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'iso-8859-1': 'cp1252'}
+
+
+def _normalize_encoding(encoding):
+    encoding = encoding.lower()
+    encoding = ENCODING_ALIASES.get(encoding, encoding)
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return None
+
+
+def _detect_encoding(content):
+    # 统计检测，最慢，尽量不走到这一步
+    sample = content[:DETECT_SAMPLE_BYTES]
+    try:
+        import charset_normalizer
+        best = charset_normalizer.from_bytes(sample).best()
+        return best.encoding if best else None
+    except ImportError:
+        import chardet
+        return chardet.detect(sample)['encoding']
+
+
+def encoding_cache_key(url):
+    # 按 host 和路径第一段区分页面类型，如 tieba.baidu.com/p/123 -> ('tieba.baidu.com', 'p')
+    parts = urlsplit(url)
+    path = parts.path.strip('/')
+    return parts.hostname, path.split('/', 1)[0] if '/' in path else ''
+
+
+def decode_html(url, content_type, content):
+    """
+    把网页字节解码成文本
+    依次使用：HTTP 头的 charset、该类页面缓存的编码、前几 KB 里的 <meta charset>、
+    utf-8 试解码、统计检测。后三种得到的编码会被缓存
+    :param url: 网址，用于缓存
+    :param content_type: Content-Type 头
+    :param content: 网页字节
     :return: 网页源代码
     """
+    match = HEADER_CHARSET_RE.search(content_type or '')
+    encoding = _normalize_encoding(match.group(1)) if match else None
+    if encoding:
+        return content.decode(encoding, errors='replace')
+
+    key = encoding_cache_key(url)
+    encoding = _encoding_cache.get(key)
+    if encoding:
+        return content.decode(encoding, errors='replace')
+
+    match = META_CHARSET_RE.search(content[:META_SNIFF_BYTES])
+    if match:
+        encoding = _normalize_encoding(match.group(1).decode('ascii'))
+    if encoding:
+        html = content.decode(encoding, errors='replace')
+    else:
+        try:
+            html = content.decode('utf-8')
+            if content.isascii():
+                # 纯 ASCII 说明不了是什么编码，不缓存
+                return html
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = _normalize_encoding(_detect_encoding(content) or 'utf-8') or 'utf-8'
+            html = content.decode(encoding, errors='replace')
+    _encoding_cache[key] = encoding
+    return html
+
+
+# 可以重试的 HTTP 状态码，其余 4xx 视为永久失败
+RETRYABLE_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+# 请求失败后不值得重试的异常
+PERMANENT_EXCEPTIONS = (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                        requests.exceptions.InvalidSchema, requests.exceptions.TooManyRedirects)
+
+
+class RetryPolicy(object):
+    """
+    重试策略：指数退避加随机抖动，并限制每个 URL 花费的总时间
+    """
+
+    def __init__(self, max_attempts=5, deadline=60, timeout=20, base_delay=0.5, max_delay=8):
+        """
+        :param max_attempts: 最多请求次数
+        :param deadline: 每个 URL 最多花费的秒数（包括退避等待）
+        :param timeout: 单次请求超时秒数，不会超过剩余时间
+        :param base_delay: 第一次退避的基准秒数，之后每次翻倍
+        :param max_delay: 单次退避的最大秒数
+        """
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        # 第 attempt 次失败后等待的秒数（full jitter）
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def is_retryable_status(status_code):
+        return status_code in RETRYABLE_STATUS_CODES
+
+    @staticmethod
+    def is_retryable_exception(e):
+        return not isinstance(e, PERMANENT_EXCEPTIONS)
+
+
+class FetchResult(object):
+    """
+    一次抓取的结果
+    status: 'ok' 成功; 'permanent' 永久失败（404、非法URL等）;
+            'exhausted' 重试次数用完; 'deadline' 超过总时间限制;
+            流式下载时还有 'aborted' 出现了提示语（html 为已下载的部分）; 'too_large' 超过大小限制;
+            'skipped' 不是 HTML
+    """
+
+    def __init__(self, url, status, html='', status_code=None, error=None, attempts=0, elapsed=0.0):
+        self.url = url
+        self.status = status
+        self.html = html
+        self.status_code = status_code
+        self.error = error
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+    def __repr__(self):
+        return '<FetchResult {0} {1} code={2} attempts={3}>'.format(self.status, self.url, self.status_code,
+                                                                    self.attempts)
+
+
+# 默认重试策略
+RETRY_POLICY = RetryPolicy()
+
+# get_html 不记录错误的抓取结果：永久失败，以及流式下载时按规则放弃的
+QUIET_FETCH_STATUSES = ('permanent', 'aborted', 'skipped')
+
+# 按 host 限速的令牌桶（rate_limiter.HostRateLimiter），None 表示不限速
+_rate_limiter = None
+
+
+def set_rate_limiter(limiter):
+    """
+    设置所有请求共用的限速器，要在 fork 子进程之前调用，子进程才能共享
+    :param limiter: rate_limiter.HostRateLimiter 或 None
+    """
+    global _rate_limiter
+    _rate_limiter = limiter
+
+
+def get_rate_limiter():
+    return _rate_limiter
+
+
+# 代理池（proxy_pool.ProxyPool），None 表示不使用代理
+_proxy_pool = None
+
+# 这些状态码说明代理被目标网站封了或者代理本身不可用
+PROXY_BANNED_STATUS_CODES = (403, 407, 429)
+
+
+def set_proxy_pool(pool):
+    """
+    设置请求使用的代理池，要在 fork 子进程之前调用
+    :param pool: proxy_pool.ProxyPool 或 None
+    """
+    global _proxy_pool
+    _proxy_pool = pool
+
+
+def get_proxy_pool():
+    return _proxy_pool
+
+
+class StreamLimits(object):
+    """
+    流式下载：边下载边检查，满足条件就断开连接，不再下载剩下的部分
+    """
+
+    def __init__(self, abort_markers=(), max_bytes=8 * 1024 * 1024, html_only=True, chunk_size=8192,
+                 drain_bytes=32 * 1024):
+        """
+        :param abort_markers: 网页里出现这些文字就停止下载（如被删帖子的提示语），按 utf-8 和 gbk 编码查找
+        :param max_bytes: 最多下载多少字节，超过就放弃
+        :param html_only: 不是 HTML 的内容（图片、压缩包等）不下载
+        :param chunk_size: 每次读多少字节
+        :param drain_bytes: 出现提示语时剩下的不超过这么多字节就读完，保住 keep-alive 连接（断开后要重新握手）
+        """
+        markers = set()
+        for marker in abort_markers:
+            for encoding in ('utf-8', 'gbk'):
+                try:
+                    markers.add(marker.encode(encoding))
+                except UnicodeEncodeError:
+                    pass
+        self.abort_markers = sorted(markers)
+        # 提示语可能被分在两块里，每次从上一块末尾往前这么多字节开始找
+        self.overlap = max([len(marker) for marker in markers] or [1]) - 1
+        self.max_bytes = max_bytes
+        self.html_only = html_only
+        self.chunk_size = chunk_size
+        self.drain_bytes = drain_bytes
+
+    @classmethod
+    def from_site_spec(cls, spec):
+        """
+        :param spec: site_specs.py 中一个网站的规则，使用其中的 fetch
+        :return: StreamLimits
+        """
+        fetch = spec.get('fetch', {})
+        return cls(fetch.get('abort', []), fetch.get('max_bytes', 8 * 1024 * 1024), fetch.get('html_only', True))
+
+    def check_headers(self, content_type, content_length):
+        """
+        :return: 可以下载返回 None，否则返回放弃的原因 'skipped' / 'too_large'
+        """
+        content_type = (content_type or '').lower()
+        if self.html_only and content_type and not content_type.startswith('text/') and \
+                'html' not in content_type and 'xml' not in content_type:
+            return 'skipped'
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            return 'too_large'
+        return None
+
+    def should_drain(self, received, content_length):
+        # 提前结束时是否把剩下的读完（只在知道总长度时）
+        return bool(content_length and content_length.isdigit() and
+                    int(content_length) - received <= self.drain_bytes)
+
+    def feed(self, body, chunk):
+        """
+        把新读到的一块加到 body 后面
+        :param body: bytearray
+        :param chunk: 新读到的字节
+        :return: 继续读返回 None，否则返回提前结束的原因 'aborted' / 'too_large'
+        """
+        start = max(0, len(body) - self.overlap)
+        body += chunk
+        if len(body) > self.max_bytes:
+            return 'too_large'
+        for marker in self.abort_markers:
+            if body.find(marker, start) != -1:
+                return 'aborted'
+        return None
+
+
+# 流式下载的限制（StreamLimits），None 表示一次读完整个响应
+_stream_limits = None
+
+
+def set_stream_limits(limits):
+    """
+    设置所有请求使用的流式下载限制，要在 fork 子进程之前调用
+    :param limits: StreamLimits 或 None
+    """
+    global _stream_limits
+    _stream_limits = limits
+
+
+def get_stream_limits():
+    return _stream_limits
+
+
+def read_limited(resp, limits):
+    """
+    按 limits 流式读取 requests 的响应（stream=True），提前结束时关闭连接
+    :param resp: requests.Response
+    :param limits: StreamLimits
+    :return: (提前结束的原因，读完为 None, 已经读到的字节)
+    """
+    body = bytearray()
+    content_length = resp.headers.get('content-length')
+    reason = limits.check_headers(resp.headers.get('content-type', ''), content_length)
+    if reason is None:
+        chunks = resp.iter_content(limits.chunk_size)
+        for chunk in chunks:
+            reason = limits.feed(body, chunk)
+            if reason is not None:
+                break
+        if reason == 'aborted' and limits.should_drain(len(body), content_length):
+            for _ in chunks:
+                pass
+            return reason, bytes(body)
+    if reason is not None:
+        resp.close()
+    return reason, bytes(body)
+
+
+def fetch_html(url, use_proxy=None, policy=None, limits=None):
+    """
+    获取URL的源代码，按重试策略区分可重试和永久失败
+    :param url: 网址
+    :param use_proxy: 是否使用代理，默认设置了代理池就使用
+    :param policy: 重试策略，默认 RETRY_POLICY
+    :param limits: 流式下载的限制，默认为 set_stream_limits 设置的
+    :return: FetchResult
+    """
+    policy = policy or RETRY_POLICY
+    limits = limits or _stream_limits
+    if use_proxy is None:
+        use_proxy = _proxy_pool is not None
+    start_time = time.time()
+    end_time = start_time + policy.deadline
     attempts = 0
-    attempts_times = 20
-    while attempts < attempts_times:
+    status_code = None
+    error = None
+    while True:
+        remaining = end_time - time.time()
+        if remaining <= 0:
+            return FetchResult(url, 'deadline', status_code=status_code, error=error, attempts=attempts,
+                               elapsed=time.time() - start_time)
+        attempts += 1
+        proxy = None
         try:
+            if _rate_limiter is not None:
+                _rate_limiter.acquire_url(url)
+            session = get_session()
+            _mark_host_used(url)
             headers = {'user-agent': random.choice(USER_AGENT_LIST)}
-            if use_proxy:
-                proxies = {'http': random.choice(PROXIES_LIST)}
-                req = requests.get(url, timeout=20, headers=headers, proxies=proxies)
+            timeout = min(policy.timeout, remaining)
+            if use_proxy and _proxy_pool is not None:
+                proxy = _proxy_pool.choose()
+            request_time = time.time()
+            stream = limits is not None
+            if proxy:
+                proxies = {'http': proxy, 'https': proxy}
+                req = session.get(url, timeout=timeout, headers=headers, proxies=proxies, stream=stream)
             else:
-                req = requests.get(url, timeout=20, headers=headers)
-            html = req.text
-            return html
+                req = session.get(url, timeout=timeout, headers=headers, stream=stream)
+            status_code = req.status_code
+            if proxy:
+                _proxy_pool.report(proxy, status_code not in PROXY_BANNED_STATUS_CODES, time.time() - request_time)
+            if status_code < 400:
+                content_type = req.headers.get('content-type', '')
+                if stream:
+                    reason, content = read_limited(req, limits)
+                    if reason is not None:
+                        html = decode_html(url, content_type, content) if reason == 'aborted' else ''
+                        return FetchResult(url, reason, html=html, status_code=status_code, attempts=attempts,
+                                           elapsed=time.time() - start_time)
+                else:
+                    content = req.content
+                html = decode_html(url, content_type, content)
+                return FetchResult(url, 'ok', html=html, status_code=status_code, attempts=attempts,
+                                   elapsed=time.time() - start_time)
+            if stream:
+                # 读完错误页面，连接才能放回连接池
+                req.content
+            error = 'HTTP {}'.format(status_code)
+            retryable = policy.is_retryable_status(status_code)
+            if proxy and status_code in PROXY_BANNED_STATUS_CODES:
+                retryable = True
         except Exception as e:
-            attempts = attempts + 1
-            if attempts == attempts_times:
-                logging.error('Get html: {0}: {1}'.format(e, url))
-                return ''
+            error = e
+            retryable = policy.is_retryable_exception(e)
+            if proxy:
+                _proxy_pool.report(proxy, False)
+                # 代理的问题，换一个代理还可以重试
+                retryable = True
+
+        if not retryable:
+            return FetchResult(url, 'permanent', status_code=status_code, error=error, attempts=attempts,
+                               elapsed=time.time() - start_time)
+        if attempts >= policy.max_attempts:
+            return FetchResult(url, 'exhausted', status_code=status_code, error=error, attempts=attempts,
+                               elapsed=time.time() - start_time)
+        time.sleep(min(policy.backoff(attempts - 1), max(0, end_time - time.time())))
+
+
+def get_html(url, use_proxy=None):
+    """
+    获取URL的源代码，同一进程内的请求复用 keep-alive 连接
+    需要区分失败原因时用 fetch_html
+    :param url: 网址
+    :param use_proxy: 是否使用代理，默认设置了代理池就使用
+    :return: 网页源代码，失败返回空字符串
+    """
+    result = fetch_html(url, use_proxy=use_proxy)
+    if not result.ok:
+        if result.status not in QUIET_FETCH_STATUSES:
+            logging.error('Get html ({0}): {1}: {2}'.format(result.status, result.error, url))
+        return ''
+    return result.html
 
 
 def remove_html_tag(html):
@@ -159,32 +626,6 @@ def remove_html_tag(html):
     return html
 
 
-def regularly_get_proxy():
-    # 定时执行刷新代理地址列表, 通过第三方API获取代理地址
-    while True:
-        try:
-            response = get_html('http://lab.crossincode.com/proxy/get/?num=100')
-            raw_proxies = json.loads(response)['proxies']
-            proxies = []
-            logging.warning('Get proxies ok')
-            for proxy in raw_proxies:
-                proxies.append(proxy['http'])
-
-            if PROXIES_LIST:
-                for i in range(int(len(PROXIES_LIST) / 2)):
-                    PROXIES_LIST.pop(0)
-            for proxy in proxies:
-                if proxy not in PROXIES_LIST:
-                    PROXIES_LIST.append(proxy)
-            if not PROXIES_LIST:
-                continue
-            logging.warning('Proxies: ' + str(len(PROXIES_LIST)) + str(PROXIES_LIST))
-            time.sleep(100000)
-        except Exception as e:
-            logging.error('Regularly get proxies: {}'.format(e))
-            continue
-
-
 def save_content(path, content, mode):
     """
     保存文本
@@ -211,4 +652,93 @@ def deduplicate_save_content(path, content):
                     fw.write(line + '\n')
                     duplicate.add(line)
     except Exception as e:
-        logging.error('Deduplicate save: {}'.format(e))
\ No newline at end of file
+        logging.error('Deduplicate save: {}'.format(e))
+
+
+def safe_file_name(name):
+    # 把文件名里不能用的字符换成 _
+    return re.sub(r'/|[\\]|[ ]|[|]|[:]|[*]|[<]|[>]|[?]|[\']|["]', '_', name)
+
+
+def read_lines_in_batches(path, batch_size=10000, name='', report_interval=5):
+    """
+    流式读取文本文件，每次返回一批去掉首尾空白的非空行，并定期输出读取进度
+    :param path: 文件路径，不存在时什么也不返回
+    :param batch_size: 每批多少行
+    :param name: 进度日志里的名称，为空则不输出进度
+    :param report_interval: 每隔多少秒输出一次进度
+    :return: 生成器，每次一个行列表
+    """
+    if not os.path.exists(path):
+        return
+    total_bytes = os.path.getsize(path) or 1
+    read_bytes = 0
+    count = 0
+    start_time = last_report = time.time()
+    batch = []
+    with open(path, 'rb') as fr:
+        for raw_line in fr:
+            read_bytes += len(raw_line)
+            line = raw_line.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            batch.append(line)
+            if len(batch) >= batch_size:
+                count += len(batch)
+                yield batch
+                batch = []
+                if name and time.time() - last_report >= report_interval:
+                    last_report = time.time()
+                    logging.warning('载入{0}: {1:.1f}%, {2} 条, {3:.0f} 条/秒'.format(
+                        name, read_bytes * 100 / total_bytes, count, count / (last_report - start_time)))
+    if batch:
+        count += len(batch)
+        yield batch
+    if name:
+        logging.warning('载入{0}完成: {1} 条, 用时 {2:.1f} 秒'.format(name, count, time.time() - start_time))
+
+
+class BufferedAppender(object):
+    """
+    追加写文本文件，先在本进程里攒着，够一定行数或者时间再一次写入，不用每行都打开一次文件
+    fork 出的子进程各自有自己的缓冲
+    """
+
+    def __init__(self, path, max_lines=200, max_seconds=1.0, encoding='utf-8'):
+        """
+        :param path: 文件路径
+        :param max_lines: 缓冲多少行后写入
+        :param max_seconds: 缓冲最多保留多少秒
+        :param encoding: 文件编码
+        """
+        self.path = path
+        self.max_lines = max_lines
+        self.max_seconds = max_seconds
+        self.encoding = encoding
+        self._lines = []
+        self._pid = os.getpid()
+        self._last_flush = time.time()
+        # 异步模式下会从线程池里调用
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            if self._pid != os.getpid():
+                # 不要把父进程还没写入的内容再写一遍
+                self._lines = []
+                self._pid = os.getpid()
+            self._lines.append(text)
+            if len(self._lines) >= self.max_lines or time.time() - self._last_flush >= self.max_seconds:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.time()
+        if not self._lines:
+            return
+        lines, self._lines = self._lines, []
+        with open(self.path, 'a', encoding=self.encoding) as fw:
+            fw.write(''.join(lines))